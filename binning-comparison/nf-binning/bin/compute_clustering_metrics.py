@@ -6,7 +6,7 @@ from itertools import combinations
 
 import numpy as np
 import pandas as pd
-from Bio import SeqIO
+import scipy.sparse
 import sklearn.metrics
 
 
@@ -16,7 +16,11 @@ def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--bins', type=str, nargs='+')
     parser.add_argument('--truth', type=str)
-    parser.add_argument('--fasta', type=str, default=None)    
+    parser.add_argument('--fasta', type=str, default=None,
+                        help='Assembly, to score the contigs by length quantile (lengths read from its .fai index)')
+    parser.add_argument('--h5', type=str, default=None,
+                        help='Coverage file to get the contig lengths from instead of the fasta')
+    parser.add_argument('--n-strata', type=int, default=5, help='Number of contig length quantiles')
     parser.add_argument('--output', type=str)
     parser.add_argument('--name', type=str, default='dataset')
     parser.add_argument('--metrics', type=str, nargs='+', default=METRICS)    
@@ -61,72 +65,184 @@ def load(files, truth=None):
 def n_combs(x):
     return x * (x-1) // 2 
 
-def eval_true_bin(assn):
+def get_contig_lengths(fasta=None, h5=None):
     """
-    assn (list): contig assignments for a given true bin
+    Contig lengths from the index of the coverage file or from the faidx index of the fasta
     """
 
-    freqs = assn.value_counts().values
-    tp = n_combs(freqs).sum()
-    fn = n_combs(len(assn)) - tp
-    
-    return (tp, fn)
+    # Only needed for the stratified scores (helpers from the bin folder)
+    if h5 is not None:
+        import h5py
+        from coverage_h5 import get_names, get_lengths
+
+        with h5py.File(h5, 'r') as handle:
+            return pd.Series(get_lengths(handle), index=get_names(handle))
+
+    from merge_bins import FastaIndex
+    index = FastaIndex(fasta).index
 
-def eval_pred_bin(assn):
+    return pd.Series([entry[0] for entry in index.values()], index=list(index))
+
+def get_contingency(truth, pred, strata=None, n_strata=1):
     """
-    assn (list): contig assignments for a given predicted bin
+    truth, pred (np.array): integer codes of the true and predicted bins
+    strata (np.array): stratum code of each contig (between 0 and n_strata-1)
+    Returns the sparse (true bins x predicted bins) matrix of contig counts.
+    With strata, the matrices of each stratum are stacked vertically.
     """
 
-    freqs = assn.value_counts()
-    tp = n_combs(freqs).sum()
-    fp = n_combs(len(assn)) - tp
+    n_truth = truth.max() + 1
+    rows = truth if strata is None else strata * n_truth + truth
 
-    return fp
+    counts = np.ones(len(truth), dtype=np.int64)
+    # duplicated (truth, pred) entries are summed by the conversion to csr
+    return scipy.sparse.coo_matrix((counts, (rows, pred)),
+                                   shape=(n_strata * n_truth, pred.max()+1)).tocsr()
 
-def compute_scores(data, output=None, metrics=None, name=None):
-    scores = dict()
-    
-    for method in data.columns.drop('truth'):
-        grouped_by_truth = data.groupby('truth')[method].agg(eval_true_bin)
-        grouped_by_pred = data.groupby(method).truth.agg(eval_pred_bin)
+def split_strata(table, n_truth):
+    """
+    Global contingency matrix and the matrix of each stratum
+    from the stacked matrices of get_contingency
+    """
 
-        scores[method] = dict(
-            TP=grouped_by_truth.str[0].sum(),
-            FN=grouped_by_truth.str[1].sum(),
-            FP=grouped_by_pred.sum(),
-        )
-        scores[method]['TN'] = n_combs(len(data)) - sum(scores[method].values())
+    n_strata = table.shape[0] // n_truth
+    blocks = [table[i*n_truth:(i+1)*n_truth] for i in range(n_strata)]
+
+    return (sum(blocks[1:], blocks[0]), blocks)
 
-        # Other metrics
-        for metric in metrics:
+def entropy(sizes):
+    p = sizes[sizes > 0] / sizes.sum()
+    return -(p * np.log(p)).sum()
+
+def eval_contingency(table):
+    """
+    table (scipy.sparse.csr_matrix): contingency matrix of one method
+    Returns the pair counts and the metrics that can be derived from the matrix,
+    with the same conventions as sklearn for the edge cases
+    """
+
+    table = table.tocoo()
+    n_ij = table.data[table.data > 0]
+    (true_sizes, pred_sizes) = (np.asarray(table.sum(axis=i)).ravel() for i in (1, 0))
+    n = true_sizes.sum()
+
+    # Contig pairs in the same true bin (TP+FN) and in the same predicted bin (TP+FP)
+    tp = n_combs(n_ij).sum()
+    fn = n_combs(true_sizes).sum() - tp
+    fp = n_combs(pred_sizes).sum() - tp
+    tn = n_combs(n) - tp - fp - fn
+
+    (tp_, fp_, fn_, tn_) = map(float, (tp, fp, fn, tn))
+    if fn == 0 and fp == 0:
+        ari = 1.0
+    else:
+        ari = 2 * (tp_*tn_ - fn_*fp_) / ((tp_+fn_)*(fn_+tn_) + (tp_+fp_)*(fp_+tn_))
+
+    # Mutual information and entropies, for homogeneity and completeness
+    mask = table.data > 0
+    (rows, cols) = (table.row[mask], table.col[mask])
+    mi = max(0, (n_ij / n * (np.log(n_ij) + np.log(n)
+                             - np.log(true_sizes[rows]) - np.log(pred_sizes[cols]))).sum())
+    (h_true, h_pred) = (entropy(true_sizes), entropy(pred_sizes))
+
+    homogeneity = mi / h_true if h_true else 1.0
+    completeness = mi / h_pred if h_pred else 1.0
+
+    return dict(
+        TP=tp, FN=fn, FP=fp, TN=tn,
+        adjusted_rand_score=ari,
+        homogeneity_score=homogeneity,
+        completeness_score=completeness,
+        v_measure_score=(2 * homogeneity * completeness / (homogeneity + completeness)
+                         if homogeneity + completeness else 0.0),
+        fowlkes_mallows_score=tp_ / np.sqrt((tp_+fp_) * (tp_+fn_)) if tp else 0.0
+    )
+
+def eval_method(table, truth, pred, metrics):
+    method_scores = eval_contingency(table)
+    scores = {key: method_scores[key] for key in ['TP', 'FN', 'FP', 'TN']}
+
+    # Other metrics
+    for metric in metrics:
+        if metric in method_scores:
+            scores[metric] = method_scores[metric]
+        else:
             fn = getattr(sklearn.metrics, metric)
-            scores[method][metric] = fn(data.truth, data[method])
+            scores[metric] = fn(truth, pred)
 
+    return scores
+
+def to_frame(scores, name=None):
     scores = pd.DataFrame(scores).T.astype({col: int for col in ['TP', 'TN', 'FP', 'FN']})
     scores['dataset'] = name
 
+    return scores
+
+def compute_scores(data, output=None, metrics=None, name=None, strata=None):
+    """
+    Scores of each method. If `strata` (categorical of the length quantile of
+    each contig, NaN if unknown) is provided, the scores within each stratum
+    are also returned, computed from the same contingency matrix as the
+    global scores.
+    """
+
+    scores = dict()
+    scores_by_stratum = dict()
+    truth = data.truth.to_numpy()
+    n_truth = truth.max() + 1
+
+    if strata is None:
+        (codes, labels) = (np.zeros(len(data), dtype=int), [])
+    else:
+        labels = [f'[{int(itv.left)}, {int(itv.right)}]' for itv in strata.cat.categories]
+        # contigs with an unknown length go to an extra stratum (only in the global scores)
+        codes = np.where(strata.cat.codes < 0, len(labels), strata.cat.codes).astype(int)
+
+    for method in data.columns.drop('truth'):
+        pred = data[method].to_numpy()
+        # All the scores of the method come from a single contingency matrix
+        (table, blocks) = split_strata(
+            get_contingency(truth, pred, strata=codes, n_strata=codes.max()+1), n_truth
+        )
+
+        scores[method] = eval_method(table, truth, pred, metrics)
+
+        for (i, label) in enumerate(labels):
+            if blocks[i].nnz == 0:
+                continue
+            in_stratum = codes == i
+            scores_by_stratum[(label, method)] = eval_method(
+                blocks[i], truth[in_stratum], pred[in_stratum], metrics
+            )
+
+    scores = to_frame(scores, name=name)
+
     if output is not None:
         scores.to_csv(output)
 
-    return scores
+    if strata is None:
+        return (scores, None)
+
+    # Ordered by stratum, then method
+    scores_by_stratum = to_frame(scores_by_stratum, name=name).reindex(labels, level=0)
+
+    return (scores, scores_by_stratum)
     
 
 if __name__ == '__main__':
     args = parse_args()
     data = load(args.bins, truth=args.truth)
-    print('---- Global scores ----')
-    compute_scores(data, output=args.output, metrics=args.metrics, name=args.name)
 
-    if args.fasta is not None:
-        scores = {}
-        contigs_size = pd.Series({ctg.id: len(ctg.seq)
-                                  for ctg in SeqIO.parse(args.fasta, 'fasta')})
-        quant_bins = pd.qcut(contigs_size, 5)
-        
-        for itv in quant_bins.cat.categories:
-            subset = data.loc[quant_bins == itv]
-            scores[f'[{int(itv.left)}, {int(itv.right)}]'] = compute_scores(subset, output=None, metrics=args.metrics)
+    strata = None
+    if args.fasta is not None or args.h5 is not None:
+        lengths = get_contig_lengths(fasta=args.fasta, h5=args.h5).reindex(data.index)
+        strata = pd.qcut(lengths, args.n_strata, duplicates='drop')
 
-        scores = pd.concat(scores).reset_index(level=1, drop=True)
+    (scores, scores_by_length) = compute_scores(data, output=args.output, metrics=args.metrics,
+                                                name=args.name, strata=strata)
+    print('---- Global scores ----')
+    print(scores)
 
-        print(scores)
+    if scores_by_length is not None:
+        print('---- Scores by contig length ----')
+        print(scores_by_length)
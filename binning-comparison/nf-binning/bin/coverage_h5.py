@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+
+'''
+Coverage H5 files in two layouts:
+
+- "datasets": one (n_samples, contig_length) dataset per contig,
+  as written by CAMISIM's depth_to_h5.py and read by CoCoNet
+- "ragged": all contigs concatenated in a single chunked and compressed
+  (n_samples, total_length) `coverage` dataset, with the `names`, `offsets`
+  and `lengths` of the contigs as an index
+
+The readers below work with both layouts. Convert a file with:
+    python coverage_h5.py <input.h5> <output.h5> [--to ragged|datasets]
+
+Nextflow only stages the bin/ folder of a pipeline, so nf-binning/bin and
+nf-camisim/bin have their own copy of this file: keep them in sync.
+'''
+
+import argparse
+
+import numpy as np
+import h5py
+
+
+LAYOUT_ATTR = 'layout'
+CHUNK_LEN = 2**16
+
+
+def parse_args():
+    '''
+    '''
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('input', type=str)
+    parser.add_argument('output', type=str)
+    parser.add_argument('--to', type=str, default='ragged', choices=['ragged', 'datasets'])
+    args = parser.parse_args()
+
+    return args
+
+class RaggedCoverageWriter:
+    '''
+    Append contigs to a ragged coverage file. Contigs are buffered
+    and written in blocks of at least `block_len` positions.
+    If `dtype` is None, the type of the first contig is used.
+    '''
+
+    def __init__(self, path, n_samples, dtype=np.uint32, block_len=2**22):
+        self.handle = h5py.File(path, 'w')
+        self.handle.attrs[LAYOUT_ATTR] = 'ragged'
+        self.n_samples = n_samples
+        self.dtype = dtype
+        self.coverage = None
+        self.block_len = block_len
+
+        self.names = []
+        self.lengths = []
+        self.buffer = []
+        self.buffered = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def append(self, name, coverage):
+        self.names.append(name)
+        self.lengths.append(coverage.shape[1])
+        self.buffer.append(coverage)
+        self.buffered += coverage.shape[1]
+
+        if self.buffered >= self.block_len:
+            self.flush()
+
+    def create_dataset(self, dtype):
+        self.coverage = self.handle.create_dataset(
+            'coverage', shape=(self.n_samples, 0), maxshape=(self.n_samples, None),
+            dtype=self.dtype or dtype, chunks=(self.n_samples, CHUNK_LEN),
+            compression='gzip', shuffle=True
+        )
+
+    def flush(self):
+        if not self.buffer:
+            return
+
+        if self.coverage is None:
+            self.create_dataset(self.buffer[0].dtype)
+
+        end = self.coverage.shape[1]
+        self.coverage.resize(end + self.buffered, axis=1)
+        self.coverage[:, end:] = np.concatenate(self.buffer, axis=1)
+
+        self.buffer = []
+        self.buffered = 0
+
+    def close(self):
+        self.flush()
+
+        if self.coverage is None:
+            self.create_dataset(np.uint32)
+
+        lengths = np.array(self.lengths, dtype=np.int64)
+        self.handle.create_dataset('names', data=self.names, dtype=h5py.string_dtype())
+        self.handle.create_dataset('lengths', data=lengths)
+        self.handle.create_dataset('offsets', data=np.cumsum(lengths) - lengths)
+        self.handle.close()
+
+class DatasetsCoverageWriter:
+    '''
+    Same interface as RaggedCoverageWriter, with one dataset per contig
+    '''
+
+    def __init__(self, path, n_samples=None, dtype=None):
+        self.handle = h5py.File(path, 'w')
+        self.dtype = dtype
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def append(self, name, coverage):
+        self.handle.create_dataset(name, data=coverage, dtype=self.dtype)
+
+    def close(self):
+        self.handle.close()
+
+def coverage_writer(path, n_samples, layout='datasets', dtype=np.uint32):
+    if layout == 'ragged':
+        return RaggedCoverageWriter(path, n_samples, dtype=dtype)
+    return DatasetsCoverageWriter(path, n_samples, dtype=dtype)
+
+def is_ragged(handle):
+    return handle.attrs.get(LAYOUT_ATTR) == 'ragged'
+
+def get_names(handle):
+    if is_ragged(handle):
+        return handle['names'].asstr()[:].tolist()
+    return list(handle.keys())
+
+def get_lengths(handle):
+    if is_ragged(handle):
+        return handle['lengths'][:]
+    return np.array([dataset.shape[1] for dataset in handle.values()])
+
+def get_n_samples(handle):
+    if is_ragged(handle):
+        return handle['coverage'].shape[0]
+    return next(iter(handle.values())).shape[0]
+
+def iter_blocks(handle, block_len=2**22):
+    '''
+    Consecutive contigs of a ragged file, read by blocks of about
+    `block_len` positions: yields (contig indices, block, offsets in the block)
+    '''
+
+    (offsets, lengths) = (handle['offsets'][:], handle['lengths'][:])
+    ends = offsets + lengths
+
+    i = 0
+    while i < len(offsets):
+        # at least one contig per block
+        j = max(i+1, np.searchsorted(ends, offsets[i] + block_len, side='right'))
+        block = handle['coverage'][:, offsets[i]:ends[j-1]]
+
+        yield (np.arange(i, j), block, offsets[i:j] - offsets[i])
+        i = j
+
+def iter_coverage(handle, block_len=2**22):
+    '''
+    (name, coverage) of all the contigs, in the order of the file
+    '''
+
+    if not is_ragged(handle):
+        for (name, dataset) in handle.items():
+            yield (name, dataset[:])
+        return
+
+    names = get_names(handle)
+    lengths = handle['lengths'][:]
+
+    for (idx, block, offsets) in iter_blocks(handle, block_len=block_len):
+        for (i, start) in zip(idx, offsets):
+            yield (names[i], block[:, start:start+lengths[i]])
+
+def get_moments(handle, block_len=2**22):
+    '''
+    Per-contig sums of the coverage and of its square in each sample,
+    as (n_contigs, n_samples) arrays (float64)
+    '''
+
+    n_contigs = len(handle['lengths']) if is_ragged(handle) else len(handle)
+    sums = np.zeros((n_contigs, get_n_samples(handle)))
+    squares = np.zeros_like(sums)
+
+    if not is_ragged(handle):
+        for (i, (_, coverage)) in enumerate(iter_coverage(handle)):
+            coverage = coverage.astype(np.float64)
+            sums[i] = coverage.sum(axis=1)
+            squares[i] = (coverage**2).sum(axis=1)
+
+        return (sums, squares)
+
+    lengths = handle['lengths'][:]
+
+    for (idx, block, offsets) in iter_blocks(handle, block_len=block_len):
+        # empty contigs keep their zero sums: reduceat would return the value
+        # at their offset, which is out of bounds at the end of a block
+        nonempty = lengths[idx] > 0
+        if not nonempty.any():
+            continue
+
+        (idx, offsets) = (idx[nonempty], offsets[nonempty])
+        block = block.astype(np.float64)
+        sums[idx] = np.add.reduceat(block, offsets, axis=1).T
+        squares[idx] = np.add.reduceat(block**2, offsets, axis=1).T
+
+    return (sums, squares)
+
+def convert(input_path, output_path, to='ragged'):
+    with h5py.File(input_path, 'r') as handle:
+        dtype = (handle['coverage'] if is_ragged(handle)
+                 else next(iter(handle.values()))).dtype
+
+        with coverage_writer(output_path, get_n_samples(handle),
+                             layout=to, dtype=dtype) as writer:
+            for (name, coverage) in iter_coverage(handle):
+                writer.append(name, coverage)
+
+def main():
+    '''
+    '''
+
+    args = parse_args()
+    convert(args.input, args.output, to=args.to)
+
+if __name__ == '__main__':
+    main()
@@ -6,6 +6,8 @@ import h5py
 import numpy as np
 import pandas as pd
 
+from coverage_h5 import get_names, get_lengths, get_moments
+
 
 def parser():
     parser = argparse.ArgumentParser()
@@ -18,20 +20,22 @@ def parser():
 
 def h5_to_metabat2(h5_path):
 
-    h5data = h5py.File(h5_path, 'r')
+    # works with both coverage layouts (see coverage_h5.py)
+    with h5py.File(h5_path, 'r') as h5data:
+        ctg_len = pd.Series(get_lengths(h5data), index=get_names(h5data), name='ctg_len')
+        (sums, squares) = get_moments(h5data)
 
-    ctg_len  = pd.Series({ctg: h5data[ctg].shape[1] for ctg in h5data.keys()}, name='ctg_len')
     contigs = ctg_len.index
-    n_samples = h5data[contigs[0]].shape[0]
+    n_samples = sums.shape[1]
+    lengths = ctg_len.to_numpy()[:, None]
 
     coverage = np.zeros([len(contigs), 1+2*n_samples])
 
-    for i, ctg in enumerate(contigs):
-        data = h5data.get(ctg)[:]
-        mu, sig2 = (np.mean(data,axis=1), np.var(data,axis=1))
-        coverage[i, 0] = np.sum(data) / data.shape[1]
-        coverage[i, 1::2] = mu
-        coverage[i, 2::2] = sig2
+    mu = sums / lengths
+    coverage[:, 0] = sums.sum(axis=1) / ctg_len.to_numpy()
+    coverage[:, 1::2] = mu
+    # E[x^2] - E[x]^2 can be slightly negative with floating point cancellation
+    coverage[:, 2::2] = np.maximum(squares / lengths - mu**2, 0)
 
     cols = ['avg_depth'] + [f'{fn}_{i+1}' for i in range(n_samples) for fn in ['mean', 'var']]
     coverage_table = pd.DataFrame(coverage, index=contigs, columns=cols)
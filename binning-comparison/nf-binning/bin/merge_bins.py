@@ -1,14 +1,21 @@
 #!/usr/bin/env python
 
+import mmap
 import argparse
+import tempfile
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing as mp
 
+import numpy as np
 import pandas as pd
 
 from Bio import SeqIO
+from Bio.Seq import Seq
 from Bio.SeqRecord import SeqRecord
-from Bio.Blast.Applications import NcbimakeblastdbCommandline, NcbiblastnCommandline
-from Bio.Blast import NCBIXML
+
+
+FASTA = None
 
 
 def parse_args():
@@ -19,71 +26,381 @@ def parse_args():
     parser.add_argument('--min-dtr-size', type=int, default=10)
     parser.add_argument('--max-dtr-size', type=int, default=300)
     parser.add_argument('--min-dtr-id', type=float, default=0.95)
+    parser.add_argument('--dtr-backend', type=str, default='native', choices=['native', 'blast', 'both'],
+                        help=('DTR detection with the built-in k-mer matcher or with BLAST. '
+                              '"both" uses BLAST and reports the bins where they disagree'))
+    parser.add_argument('--threads', type=int, default=1, help='Number of bins processed in parallel')
     
     args = parser.parse_args()
 
     args.blast_kw = dict(min_dtr_size=args.min_dtr_size,
                          max_dtr_size=args.max_dtr_size,
-                         min_dtr_id=args.min_dtr_id)
+                         min_dtr_id=args.min_dtr_id,
+                         backend=args.dtr_backend)
     return args
 
-                    
+class FastaIndex:
+    '''
+    Random access to the sequences of a memory-mapped fasta file through
+    a samtools faidx index: (length, offset, line_bases, line_bytes) of each
+    contig. The index is read from <fasta>.fai if it exists, otherwise it
+    is built in memory with one pass over the file.
+    '''
+
+    def __init__(self, path):
+        with open(path, 'rb') as handle:
+            self.mm = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+
+        fai = Path(f'{path}.fai')
+        if fai.is_file() and fai.stat().st_mtime >= Path(path).stat().st_mtime:
+            self.index = read_fai(fai)
+        else:
+            self.index = build_fai(self.mm)
+
+        self.names = list(self.index)
+
+    def length(self, name):
+        return self.index[name][0]
+
+    def fetch(self, name, start=0, end=None):
+        '''
+        Bytes of the sequence between `start` and `end`
+        '''
+
+        (length, offset, line_bases, line_bytes) = self.index[name]
+        end = length if end is None else min(end, length)
+        start = max(start, 0)
+
+        if start >= end:
+            return b''
+
+        # Position in the file of the i-th base
+        (start, end) = (offset + i // line_bases * line_bytes + i % line_bases
+                        for i in (start, end))
+        seq = self.mm[start:end].replace(b'\n', b'')
+
+        if line_bytes > line_bases + 1:
+            seq = seq.replace(b'\r', b'')
+
+        return seq
+
+    def extremities(self, name, size):
+        '''
+        First and last `size` bases of the sequence (the whole sequence if it is shorter than 2*size)
+        '''
+
+        length = self.length(name)
+
+        if length <= 2*size:
+            return self.fetch(name).decode()
+
+        return (self.fetch(name, 0, size) + self.fetch(name, length-size)).decode()
+
+def read_fai(path):
+    fai = pd.read_csv(path, sep='\t', header=None, usecols=range(5), index_col=0,
+                      dtype={0: str})
+
+    return dict(zip(fai.index, fai.itertuples(index=False, name=None)))
+
+def build_fai(mm):
+    '''
+    Same index as `samtools faidx`, as {name: (length, offset, line_bases, line_bytes)}
+    '''
+
+    index = {}
+    pos = mm.find(b'>')
+
+    while pos != -1:
+        header_end = mm.find(b'\n', pos)
+        if header_end == -1:
+            header_end = len(mm)
+
+        name = (mm[pos+1:header_end].split() or [b''])[0].decode()
+        offset = header_end + 1
+
+        next_header = mm.find(b'\n>', header_end)
+        seq_end = len(mm) if next_header == -1 else next_header + 1
+
+        (length, line_bases, line_bytes) = get_line_layout(mm[offset:seq_end], name)
+        index[name] = (length, offset, line_bases, line_bytes)
+        pos = -1 if next_header == -1 else next_header + 1
+
+    return index
+
+def get_line_layout(region, name):
+    '''
+    (length, line_bases, line_bytes) of the sequence lines of one contig
+    '''
+
+    seq = region.rstrip(b'\r\n')
+    first_eol = region.find(b'\n')
+
+    if first_eol == -1 or first_eol >= len(seq):
+        # single line
+        return (len(seq), len(seq), first_eol + 1 if first_eol != -1 else len(seq) + 1)
+
+    line_bytes = first_eol + 1
+    line_bases = len(region[:first_eol].rstrip(b'\r'))
+
+    n_full = len(seq) // line_bytes
+    length = n_full * line_bases + len(seq) - n_full * line_bytes
+
+    # all lines but the last must have the same length
+    if (seq[line_bytes-1::line_bytes] != b'\n' * n_full
+        or seq.count(b'\n') != n_full or len(seq) - n_full*line_bytes > line_bases):
+        raise ValueError(f'Different line lengths in the sequence of {name}')
+
+    return (length, line_bases, line_bytes)
+
 def main():
+    global FASTA
 
     args = parse_args()
 
-    contigs = {ctg.id: ctg for ctg in SeqIO.parse(args.fasta, 'fasta')}
+    # Forked workers share the index and the memory map with the parent
+    FASTA = FastaIndex(args.fasta)
 
     assignments = pd.read_csv(args.bins, header=None, names=['contig', 'bin_id'])
     assignments.bin_id = pd.factorize(assignments.bin_id)[0]
-    assignments = assignments.set_index('contig').bin_id.reindex(contigs.keys())
+    assignments = assignments.set_index('contig').bin_id.reindex(FASTA.names)
     # Add singletons
     assignments[assignments.isnull()] = 1 + assignments.max() + range(assignments.isnull().sum())
     assignments = assignments.astype(int)
     
     prefix = Path(args.bins).stem
-    order_bins(assignments, contigs, output=f'{prefix}-merged.fasta', **args.blast_kw)
+    order_bins(assignments, output=f'{prefix}-merged.fasta', threads=args.threads, **args.blast_kw)
     assignments.to_csv(f'{prefix}-complete.csv')
 
-def order_bins(assignments, contigs, output=None, **blast_kw):
+def order_bins(assignments, output=None, threads=1, **blast_kw):
+    '''
+    Merge the contigs of each bin (from FASTA). The contig order of each bin
+    is found by `threads` workers, and the bins are streamed from the fasta
+    to `output` in the order of their ids.
+    '''
 
-    handle = open(output, 'w')
     grouped = assignments.reset_index().groupby('bin_id').contig.agg(list)
-    
-    for (bin_id, ctg_names) in grouped.iteritems():
+    jobs = [(bin_id, ctg_names, blast_kw) for (bin_id, ctg_names) in grouped.items()]
+
+    with open(output, 'wb') as handle:
+        if threads > 1:
+            with ProcessPoolExecutor(threads, mp_context=mp.get_context('fork')) as executor:
+                # map keeps the order of the jobs
+                merged = executor.map(merge_bin, jobs, chunksize=max(1, len(jobs) // (20*threads)))
+                write_bins(merged, handle)
+        else:
+            write_bins(map(merge_bin, jobs), handle)
+
+def write_bins(merged, handle):
+    '''
+    Write each bin one contig at a time, so that at most
+    one contig sequence is held in memory
+    '''
+
+    for (message, bin_id, ctg_names) in merged:
+        if message is not None:
+            print(message)
+
+        handle.write(f'>bin_{bin_id} size={len(ctg_names)}\n'.encode())
+        for name in ctg_names:
+            handle.write(FASTA.fetch(name))
+        handle.write(b'\n')
+
+def merge_bin(job):
+    '''
+    Order the contigs of one bin, with the DTR contigs (if any) at the extremities.
+    Only the extremities of the contigs are read. Returns the log message,
+    the bin id and the ordered contig names
+    '''
 
-        contigs_in_bin = [contigs[name] for name in ctg_names]
-        if len(ctg_names) > 1:
-            ends_fa = cut_ends(contigs_in_bin, max_dtr_size=blast_kw['max_dtr_size'])
-            blast_xml = self_blast(ends_fa)
+    (bin_id, ctg_names, blast_kw) = job
+    message = None
 
-            matches = filter_blast(blast_xml, **blast_kw)
+    if len(ctg_names) > 1:
+        contigs_in_bin = [(name, FASTA.extremities(name, blast_kw['max_dtr_size']))
+                          for name in ctg_names]
+        matches = detect_dtr(contigs_in_bin, bin_id=bin_id, **blast_kw)
 
-            if matches is not None:
-                print(f'Bin {bin_id}: DTR found for {matches[0]} and {matches[1]}')
-                first = next(ctg for ctg in contigs_in_bin if ctg.id == matches[0])
-                last = next(ctg for ctg in contigs_in_bin if ctg.id == matches[1])
-                contigs_in_bin = [ctg for ctg in contigs_in_bin if ctg.id not in matches]
-                contigs_in_bin = [first] + contigs_in_bin + [last]
-                                   
-        (name, seq) = concatenate_contigs(contigs_in_bin, bin_id=bin_id)
-        handle.write(f'>{name}\n{seq}\n')
+        if matches is not None:
+            message = f'Bin {bin_id}: DTR found for {matches[0]} and {matches[1]}'
+            ctg_names = ([matches[0]]
+                         + [name for name in ctg_names if name not in matches]
+                         + [matches[1]])
 
-    handle.close()
+    return (message, bin_id, ctg_names)
+
+def detect_dtr(contigs, bin_id=0, backend='native', **blast_kw):
+    '''
+    (first, last) contigs of a bin with a direct terminal repeat, or None.
+    `contigs` are (name, sequence) pairs, and only the max_dtr_size
+    extremities of the sequences are used.
+    '''
+
+    if backend != 'blast':
+        matches = find_dtr(contigs, **blast_kw)
+
+        if backend == 'native':
+            return matches
+
+    # Scratch directory of the bin, so that workers don't overwrite each other's files
+    with tempfile.TemporaryDirectory(prefix=f'bin_{bin_id}-', dir='.') as tmpdir:
+        ends_fa = cut_ends(contigs, max_dtr_size=blast_kw['max_dtr_size'],
+                           output=f'{tmpdir}/extr.fasta')
+        blast_xml = self_blast(ends_fa, output=f'{tmpdir}/blastn.xml', db=f'{tmpdir}/db')
+        blast_matches = filter_blast(blast_xml, **blast_kw)
+
+    if blast_matches is not None:
+        blast_matches = tuple(blast_matches)
+
+    if backend == 'both' and matches != blast_matches:
+        print(f'Bin {bin_id}: native DTR detection ({matches}) and BLAST ({blast_matches}) differ')
+
+    return blast_matches
+
+def encode(seqs, width, pad):
+    '''
+    (n_seqs, width) uint8 matrix of the sequences (A, C, G, T -> 0-3, other -> 4),
+    padded with `pad` on the right
+    '''
+
+    lookup = np.full(256, 4, dtype=np.uint8)
+    for (i, nucl) in enumerate('ACGT'):
+        lookup[ord(nucl)] = lookup[ord(nucl.lower())] = i
+
+    codes = np.full((len(seqs), width), pad, dtype=np.uint8)
+    for (i, seq) in enumerate(seqs):
+        codes[i, :len(seq)] = lookup[np.frombuffer(seq.encode(), dtype=np.uint8)]
+
+    return codes
+
+def get_kmers(codes, k):
+    '''
+    (row, position, k-mer code) of all the k-mers without N or padding
+    '''
+
+    n_kmers = codes.shape[1] - k + 1
+    kmers = np.zeros((len(codes), n_kmers), dtype=np.uint32)
+    valid = np.ones((len(codes), n_kmers), dtype=bool)
+
+    for j in range(k):
+        window = codes[:, j:j+n_kmers]
+        kmers = (kmers << 2) | (window & 3)
+        valid &= window < 4
+
+    (rows, pos) = np.nonzero(valid)
+
+    return pd.DataFrame(dict(row=rows.astype(np.uint32), pos=pos.astype(np.uint32),
+                             kmer=kmers[rows, pos]))
+
+def get_identities(first, last, overlap, starts, ends, chunk_size=2**12):
+    '''
+    Number of identical bases between first[:L] and last[width-L:width]
+    for each candidate, computed by chunks of `chunk_size` candidates
+    '''
+
+    width = starts.shape[1]
+    pos = np.arange(width, dtype=np.int32)
+    identities = np.zeros(len(first), dtype=np.int32)
+
+    for i in range(0, len(first), chunk_size):
+        chunk = slice(i, i+chunk_size)
+        length = overlap[chunk, None]
+        last_pos = np.minimum(width - length + pos, width-1)
+
+        same = starts[first[chunk, None], pos] == ends[last[chunk, None], last_pos]
+        identities[chunk] = (same & (pos < length)).sum(axis=1)
+
+    return identities
+
+def find_dtr(contigs, min_dtr_id=0.95, min_dtr_size=10, max_dtr_size=300, k=8, max_occ=50,
+             block_size=2**16):
+    '''
+    Built-in version of self_blast + filter_blast on (name, sequence) pairs:
+    look for a contig `first` whose start matches the end of another contig
+    `last`, i.e. first[:L] ~ last[-L:] with L >= min_dtr_size and
+    an identity >= min_dtr_id, within the max_dtr_size extremities.
+    As with BLAST's end anchoring, `last` needs to be at least max_dtr_size long.
+
+    Candidate overlaps L come from the k-mers shared by the start and end
+    windows (each shared k-mer sets one diagonal), then the identity is
+    computed along each candidate diagonal. Contigs are scanned in order as
+    in filter_blast, and the best match (most identities) of the first contig
+    with a match is returned. The contigs are checked by blocks of about
+    block_size / n_contigs, so that the number of candidates in memory
+    grows linearly with the size of the bin.
+    '''
+
+    width = max_dtr_size
+    names = [name for (name, _) in contigs]
+    lengths = np.array([len(seq) for (_, seq) in contigs])
+
+    starts = encode([seq[:width] for (_, seq) in contigs], width, pad=5)
+    ends = encode([seq[-width:] if len(seq) >= width else '' for (_, seq) in contigs],
+                  width, pad=6)
+
+    (start_kmers, end_kmers) = (get_kmers(starts, k), get_kmers(ends, k))
+
+    # Low complexity k-mers would create too many candidates
+    for kmers in (start_kmers, end_kmers):
+        kmers.drop(kmers.index[kmers.groupby('kmer').row.transform('size') > max_occ],
+                   inplace=True)
+
+    n_block = max(1, block_size // len(contigs))
+
+    for block_start in range(0, len(contigs), n_block):
+        block = range(block_start, min(block_start + n_block, len(contigs)))
+        matches = get_block_matches(block, start_kmers, end_kmers, starts, ends, lengths,
+                                    min_dtr_id=min_dtr_id, min_dtr_size=min_dtr_size)
+
+        for i in block:
+            # i as the query: its start (i first), then its end (i last)
+            for role in ['first', 'last']:
+                hits = matches[matches[role] == i]
+                if not hits.empty:
+                    best = hits.loc[hits.identities.idxmax()]
+                    return (names[best['first']], names[best['last']])
+
+def get_block_matches(block, start_kmers, end_kmers, starts, ends, lengths,
+                      min_dtr_id=0.95, min_dtr_size=10):
+    '''
+    Valid (first, last, identities) matches where first or last is in `block`
+    '''
+
+    width = starts.shape[1]
+    in_block = lambda kmers: kmers[(kmers.row >= block.start) & (kmers.row < block.stop)]
+
+    seeds = pd.concat([
+        in_block(start_kmers).merge(end_kmers, on='kmer', suffixes=('_first', '_last')),
+        start_kmers.merge(in_block(end_kmers), on='kmer', suffixes=('_first', '_last'))
+    ])
+
+    (first, last) = (seeds.row_first.to_numpy(np.int64), seeds.row_last.to_numpy(np.int64))
+    overlap = (width - seeds.pos_last.to_numpy(np.int32)
+               + seeds.pos_first.to_numpy(np.int32))
+
+    keep = ((first != last) & (overlap >= min_dtr_size)
+            & (overlap <= np.minimum(width, lengths[first])))
+    candidates = (pd.DataFrame(dict(first=first[keep], last=last[keep], overlap=overlap[keep]))
+                  .drop_duplicates())
+
+    (first, last, overlap) = (candidates[col].to_numpy() for col in ['first', 'last', 'overlap'])
+    identities = get_identities(first, last, overlap, starts, ends)
+    valid = identities / np.maximum(overlap, 1) >= min_dtr_id
+
+    return pd.DataFrame(dict(first=first, last=last, identities=identities))[valid]
 
 def cut_ends(contigs, max_dtr_size=300, output='extr.fasta'):
     extremities = []
 
-    for ctg in contigs:
+    for (name, seq) in contigs:
         start = SeqRecord(
-            id=f'{ctg.id}@start',
+            id=f'{name}@start',
             description='',
-            seq=ctg.seq[:max_dtr_size]
+            seq=Seq(seq[:max_dtr_size])
         )
         end = SeqRecord(
-            id=f'{ctg.id}@end',
+            id=f'{name}@end',
             description='',
-            seq=ctg.seq[-max_dtr_size:]
+            seq=Seq(seq[-max_dtr_size:])
         )
         extremities += [start, end]
 
@@ -91,12 +408,15 @@ def cut_ends(contigs, max_dtr_size=300, output='extr.fasta'):
 
     return output
 
-def self_blast(fasta, output='blastn.xml'):
+def self_blast(fasta, output='blastn.xml', db='db'):
+    # Only needed with the BLAST backend
+    from Bio.Blast.Applications import NcbimakeblastdbCommandline, NcbiblastnCommandline
+
     make_db = NcbimakeblastdbCommandline(
-        dbtype="nucl", input_file=fasta, out='db'
+        dbtype="nucl", input_file=fasta, out=db
     )
     blastn_on_db = NcbiblastnCommandline(
-        query=fasta, db='db', out=output, outfmt=5,
+        query=fasta, db=db, out=output, outfmt=5,
         task='blastn-short'
     )
 
@@ -104,7 +424,7 @@ def self_blast(fasta, output='blastn.xml'):
     blastn_on_db()
 
     # Cleaning
-    for f in Path('.').glob('db*'):
+    for f in Path(db).parent.glob(f'{Path(db).name}*'):
         f.unlink()
 
     Path(fasta).unlink()
@@ -112,6 +432,7 @@ def self_blast(fasta, output='blastn.xml'):
     return output
 
 def filter_blast(blast_xml, min_dtr_id=0.95, min_dtr_size=10, max_dtr_size=300):
+    from Bio.Blast import NCBIXML
 
     for record in NCBIXML.parse(open(blast_xml)):
         # 1 record is one blast result from the query sequences
@@ -142,11 +463,5 @@ def filter_blast(blast_xml, min_dtr_id=0.95, min_dtr_size=10, max_dtr_size=300):
                           hsp.query_start == 1 and hsp.sbjct_end == max_dtr_size):
                         return (query_name, hit_name)
 
-def concatenate_contigs(contigs, bin_id=0):
-    return (
-        f'bin_{bin_id} size={len(contigs)}',
-        ''.join(str(ctg.seq) for ctg in contigs)
-    )
-            
 if __name__ == '__main__':
     main()
@@ -41,6 +41,7 @@ process REFORMAT_COVERAGE {
 }
 
 process MERGE_BINS {
+    label 'process_low'
     publishDir "${params.outdir}/merged_bins", mode: 'copy'
     container 'nakor/coconet-paper-python'
     conda (params.conda ? 'biopython pandas bioconda::blast' : null)
@@ -58,7 +59,8 @@ process MERGE_BINS {
         --bins $bins \\
         --min-dtr-size 10 \\
         --max-dtr-size 300 \\
-        --min-dtr-id 0.95
+        --min-dtr-id 0.95 \\
+        --threads $task.cpus
     """    
 }
 
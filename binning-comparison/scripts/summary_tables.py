@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import sys
 import argparse
 from pathlib import Path
 import re
@@ -8,6 +9,9 @@ import pandas as pd
 import numpy as np
 import h5py
 
+sys.path.append(str(Path(__file__).resolve().parents[2] / 'common'))
+from coverage_h5 import get_names, get_lengths, get_moments
+
 
 def parse_args():
     '''
@@ -29,9 +33,11 @@ def parse_sim_name(name):
 def sim_stats(root, sim, noise=0.1):
     h5_file = Path(root, 'preprocessing', sim, 'coverage.h5')
     with h5py.File(h5_file, 'r') as handle:
-        prevalence = np.mean([sum(cov[:].mean(axis=1) > noise) for cov in handle.values()])
-        n_contigs = len(handle)
-        bins = pd.factorize([x.split('|')[0] for x in handle.keys()])[0]
+        (sums, _) = get_moments(handle)
+        mean_cov = sums / get_lengths(handle)[:, None]
+        prevalence = np.mean((mean_cov > noise).sum(axis=1))
+        n_contigs = len(mean_cov)
+        bins = pd.factorize([x.split('|')[0] for x in get_names(handle)])[0]
 
     infos = parse_sim_name(sim) + [n_contigs, np.bincount(bins).mean(), prevalence]
 
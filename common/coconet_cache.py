@@ -0,0 +1,186 @@
+'''
+Cache of CoCoNet's preprocessing and training outputs across runs.
+
+Entries are keyed on the content hash of the input files and on the
+Configuration fields, and hold the outputs of each step (e.g. filtered
+FASTA, H5, pairs, model). The cache is disabled unless the COCONET_CACHE
+environment variable is set to the cache location. Entries that were not
+used recently are evicted when the cache grows over COCONET_CACHE_MAX_GB
+(20 GB by default).
+'''
+
+import os
+import json
+import shutil
+import hashlib
+import logging
+from pathlib import Path
+
+
+DEFAULT_MAX_GB = 20
+# Changes when the layout of the entries changes
+CACHE_VERSION = 2
+
+# Configuration fields that do not change the cached outputs
+IGNORED_FIELDS = {
+    'io', 'action', 'threads', 'loglvl', 'verbosity', 'debug', 'quiet', 'continue',
+    'theta', 'gamma1', 'gamma2', 'vote_threshold', 'max_neighbors', 'n_clusters',
+    'algorithm', 'recruit_small_contigs',
+}
+
+
+class CoCoNetCache:
+    '''
+    Run CoCoNet steps unless their outputs are already cached
+    for the same inputs and configuration
+    '''
+
+    def __init__(self, cfg, inputs, root=None, max_gb=None):
+        if root is None:
+            root = os.environ.get('COCONET_CACHE')
+        if max_gb is None:
+            max_gb = float(os.environ.get('COCONET_CACHE_MAX_GB', DEFAULT_MAX_GB))
+
+        self.cfg = cfg
+        self.logger = logging.getLogger('<CoCoNet>')
+        self.root = Path(root) if root else None
+        self.max_bytes = max_gb * 2**30
+
+        if self.root is not None:
+            self.root.mkdir(parents=True, exist_ok=True)
+            self.key = self.get_key(inputs)
+
+    def get_key(self, inputs):
+        fields = {name: value for (name, value) in vars(self.cfg).items()
+                  if name not in IGNORED_FIELDS}
+
+        digest = hashlib.sha256(f'v{CACHE_VERSION}'.encode())
+        for filename in sorted(str(f) for f in inputs if f):
+            digest.update(content_hash(filename, memo=self.root / 'hashes.json').encode())
+        digest.update(json.dumps(fields, sort_keys=True, default=str).encode())
+
+        return digest.hexdigest()[:16]
+
+    def run(self, step, outputs):
+        '''
+        Restore the `outputs` (keys of cfg.io) of `step` from the cache,
+        or run `step` and store them
+        '''
+
+        if self.root is None:
+            return step(self.cfg)
+
+        entry = Path(self.root, self.key, step.__name__)
+        manifest = Path(entry, 'manifest.json')
+
+        if manifest.is_file():
+            # Restored to the io paths of the current run, whatever the paths of the cached run
+            io_paths = self.get_io_paths(outputs)
+            for (label, name) in json.load(open(manifest)).items():
+                dest = io_paths.get(label)
+                if dest is None:
+                    continue
+                Path(dest).parent.mkdir(parents=True, exist_ok=True)
+                # copy (not copy2) so that restored files are newer than any stale sidecar
+                shutil.copy(str(Path(entry, name)), str(dest))
+            os.utime(str(manifest))
+            self.logger.info(f'{step.__name__}: outputs restored from cache {entry}')
+            return
+
+        step(self.cfg)
+        self.store(entry, outputs)
+        self.evict()
+
+    def get_io_paths(self, outputs):
+        '''
+        {label: path} of the `outputs`, with labels "key" or "key/subkey"
+        for the io fields holding several files
+        '''
+
+        paths = {}
+        for key in outputs:
+            path = self.cfg.io[key]
+            if isinstance(path, dict):
+                paths.update({f'{key}/{subkey}': subpath for (subkey, subpath) in path.items()})
+            else:
+                paths[key] = path
+
+        return paths
+
+    def store(self, entry, outputs):
+        tmp_entry = Path(entry.parent, f'.{entry.name}-{os.getpid()}')
+        tmp_entry.mkdir(parents=True, exist_ok=True)
+
+        manifest = {}
+        for (label, path) in self.get_io_paths(outputs).items():
+            if Path(path).is_file():
+                name = label.replace('/', '.')
+                shutil.copy(str(path), str(Path(tmp_entry, name)))
+                manifest[label] = name
+
+        with open(Path(tmp_entry, 'manifest.json'), 'w') as handle:
+            json.dump(manifest, handle, indent=2)
+
+        try:
+            # Atomic: concurrent runs on the same inputs keep a single entry
+            tmp_entry.rename(entry)
+        except OSError:
+            shutil.rmtree(str(tmp_entry))
+
+    def evict(self):
+        '''
+        Remove the least recently used entries until the cache fits in max_bytes
+        '''
+
+        entries = []
+        for manifest in self.root.glob('*/*/manifest.json'):
+            size = sum(f.stat().st_size for f in manifest.parent.iterdir())
+            entries.append((manifest.stat().st_mtime, size, manifest.parent))
+
+        total = sum(size for (_, size, _) in entries)
+
+        for (_, size, entry) in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(str(entry), ignore_errors=True)
+            total -= size
+            self.logger.info(f'Evicted {entry} from the cache ({size/2**30:.1f} GB)')
+
+            # Remove the key folder with its last entry (unless an entry is being stored)
+            try:
+                entry.parent.rmdir()
+            except OSError:
+                pass
+
+def content_hash(filename, memo=None, block_size=2**20):
+    '''
+    sha256 of a file. The digests are memoized in the json file `memo`
+    using the file path, size and modification time.
+    '''
+
+    stat = os.stat(filename)
+    memo_key = f'{Path(filename).resolve()}:{stat.st_size}:{stat.st_mtime_ns}'
+
+    hashes = {}
+    if memo is not None and Path(memo).is_file():
+        try:
+            hashes = json.load(open(memo))
+        except ValueError:
+            pass
+
+    if memo_key in hashes:
+        return hashes[memo_key]
+
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as handle:
+        for block in iter(lambda: handle.read(block_size), b''):
+            digest.update(block)
+
+    if memo is not None:
+        hashes[memo_key] = digest.hexdigest()
+        tmp_memo = Path(f'{memo}.{os.getpid()}')
+        with open(tmp_memo, 'w') as handle:
+            json.dump(hashes, handle)
+        os.replace(str(tmp_memo), str(memo))
+
+    return digest.hexdigest()
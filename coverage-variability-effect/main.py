@@ -1,155 +1,560 @@
+import sys
+import argparse
 from pathlib import Path
 import re
+import copy
+import os
+import time
+import queue
 import logging
+import threading
 from collections import deque
+from functools import partial
+from itertools import chain, islice
 
 import numpy as np
 import torch
+import torch.nn as nn
 import torch.optim as optim
-from sklearn.metrics import (
-    accuracy_score,
-    precision_score,
-    recall_score,
-    confusion_matrix,
-    roc_auc_score
-)
+import torch.multiprocessing as mp
+from torch.func import stack_module_state, functional_call, vmap
 from coconet import coconet, parser
 from coconet.core.config import Configuration
 from coconet.core.generators import CoverageGenerator, CompositionGenerator
 from coconet import dl_util
 
+from prefetch import BatchPrefetcher, parent_alive
+from results import save_scores
+from profiler import NullProfiler, PhaseProfiler
+
+sys.path.append(str(Path(__file__).resolve().parents[1] / 'common'))
+from coconet_cache import CoCoNetCache, content_hash
+
 TEST_FREQ = 100
 METRICS = ['accuracy', 'AUC', 'TP', 'TN', 'FP', 'FN']
 
 
-def coconet_init(args):
+def coconet_init(args, resume=False):
     cfg = Configuration()
     cfg.init_config(**vars(args))
     cfg.to_yaml()
 
-    coconet.preprocess(cfg)
-    coconet.make_train_test(cfg)
+    # The pairs are not seeded: regenerating them would change
+    # the train/test split of the run we are resuming
+    inputs = [cfg.io['filt_fasta'], cfg.io['h5']] + list(cfg.io['pairs'].values())
+    if (resume and Path(cfg.io['output'], 'checkpoint.pt').is_file()
+            and all(Path(f).is_file() for f in inputs)):
+        logging.getLogger('<learning>').info('Resuming: reusing the preprocessed data and pairs')
+        return cfg
+
+    cache = CoCoNetCache(cfg, [args.fasta, args.h5] + (getattr(args, 'bam', None) or []))
+    cache.run(coconet.preprocess, ['filt_fasta', 'h5', 'exclude', 'dtr'])
+    cache.run(coconet.make_train_test, ['pairs'])
 
     return cfg
 
-def main():
+def parse_args():
     '''
+    Separate the options specific to this experiment from CoCoNet's CLI
     '''
 
+    exp_parser = argparse.ArgumentParser(add_help=False)
+    exp_parser.add_argument('--ensemble', action='store_true',
+                            help='Train both models as one vectorized ensemble')
+    exp_parser.add_argument('--prefetch', type=int, default=0,
+                            help='Number of batches to prefetch per worker (0 to disable)')
+    exp_parser.add_argument('--prefetch-workers', type=int, default=1,
+                            help='Number of prefetch workers')
+    exp_parser.add_argument('--prefetch-processes', action='store_true',
+                            help='Use processes instead of threads for the prefetch workers')
+    exp_parser.add_argument('--test-chunk', type=int, default=0,
+                            help=('Stream the test set in chunks of this many pairs '
+                                  '(0 to keep the whole test set in memory)'))
+    exp_parser.add_argument('--async-eval', action='store_true',
+                            help=('Evaluate the models in a background worker. '
+                                  'Early stopping uses the results up to one evaluation late'))
+    exp_parser.add_argument('--async-eval-processes', action='store_true',
+                            help='Use a process instead of a thread for the evaluation worker')
+    exp_parser.add_argument('--async-eval-deterministic', action='store_true',
+                            help=('Only apply the asynchronous results at the next evaluation, '
+                                  'so that the run does not depend on timing'))
+    exp_parser.add_argument('--profile', action='store_true',
+                            help=('Time each phase of the training and save it in profile.json '
+                                  '(the evaluation is timed for all modes together)'))
+    exp_parser.add_argument('--compile', type=str, default='none',
+                            choices=['none', 'script', 'torch-compile'],
+                            help=('Compile the forward pass and loss with TorchScript or torch.compile '
+                                  '(falls back to eager mode on failure)'))
+    exp_parser.add_argument('--replicates', type=int, default=1,
+                            help='Number of independently seeded model pairs trained on the same batches')
+    exp_parser.add_argument('--seed', type=int, default=None,
+                            help='Seed of the first replicate (the others use seed+1, seed+2, ...)')
+    exp_parser.add_argument('--checkpoint-freq', type=int, default=1000,
+                            help=('Save a checkpoint at the first evaluation after this many batches '
+                                  'since the last one (0 to disable)'))
+    exp_parser.add_argument('--resume', action='store_true',
+                            help='Resume the training from the last checkpoint in the output folder')
+    (opts, remaining) = exp_parser.parse_known_args()
+
+    sys.argv = sys.argv[:1] + remaining
     args = parser.parse_args()
 
-    cfg = coconet_init(args)
+    return (args, opts)
 
-    # load data
-    (x_test_compo, x_train_compo) = (get_composition_generator(cfg, s)
-                                     for s in ['test', 'train'])
-    (x_test_cover, x_train_cover) = (get_coverage_generator(cfg, s)
-                                     for s in ['test', 'train'])
-    (y_test, y_train) = (get_truth(cfg.io['pairs'][s]) for s in ['test', 'train'])
+def main():
+    '''
+    '''
 
-    if len(cfg.features) > 1:
-        x_train = zip(x_train_compo, x_train_cover)
-        x_test = dict(with_var=next(zip(x_test_compo, x_test_cover)))
-    else:
-        x_train = x_train_cover
-        x_test = dict(with_var=next(x_test_cover))
+    (args, opts) = parse_args()
 
-    x_test['no_var'] = flatten_coverage(x_test['with_var'])
-    y_test_npy = y_test.numpy().astype(int)
+    cfg = coconet_init(args, resume=opts.resume)
+    torch.set_num_threads(args.threads)
 
-    # Initialize models
-    n_batch = 1 + dl_util.get_npy_lines(cfg.io['pairs']['train']) // cfg.batch_size
-    nets = dict(no_var=dict(), with_var=dict())
+    logger = logging.getLogger('<learning>')
 
-    for mode in ['no_var', 'with_var']:
-        nets[mode]['model'] = dl_util.initialize_model(
-            '-'.join(cfg.features), cfg.get_input_shapes(), cfg.get_architecture()
-        ).train()
-        nets[mode]['optim'] = optim.Adam(nets[mode]['model'].parameters(), lr=cfg.learning_rate)
-        nets[mode]['loss'] = deque(maxlen=args.patience)
-        nets[mode]['over'] = False
+    checkpoint_file = Path(cfg.io['output'], 'checkpoint.pt')
+    checkpoint = None
+    pairs_hash = get_pairs_hash(cfg) if opts.checkpoint_freq > 0 or opts.resume else None
 
-    logger = logging.getLogger('<learning>')
-    logger.info('Training started')
+    if opts.resume and checkpoint_file.is_file():
+        checkpoint = torch.load(checkpoint_file, weights_only=False)
+        if checkpoint.get('pairs') != pairs_hash:
+            raise ValueError((
+                f'The pairs in {cfg.io["output"]} changed since {checkpoint_file} was saved. '
+                'Remove the checkpoint to start from scratch'
+            ))
+        opts.seed = checkpoint['seed']
+        logger.info(f'Resuming from batch #{checkpoint["batch"]:,} ({checkpoint_file})')
+    elif opts.resume:
+        logger.warning(f'No checkpoint found in {checkpoint_file.parent}. Starting from scratch')
+
+    start = 0 if checkpoint is None else checkpoint['batch']
+
+    # load data
+    (y_test, y_train) = (get_truth(cfg.io['pairs'][s]) for s in ['test', 'train'])
+    x_train = get_train_batches(cfg, opts, start=start)
+    evaluator = None
+
+    try:
+        # Initialize models
+        n_batch = 1 + dl_util.get_npy_lines(cfg.io['pairs']['train']) // cfg.batch_size
+        nets = init_models(cfg, args.patience, replicates=opts.replicates, seed=opts.seed)
+
+        if checkpoint is not None:
+            restore_checkpoint(checkpoint, nets)
+
+        ensemble = None
+        if opts.ensemble:
+            ensemble = ModelEnsemble([nets[mode]['model'] for mode in nets],
+                                     learning_rate=cfg.learning_rate)
+            if checkpoint is not None and checkpoint['ensemble'] is not None:
+                ensemble.optim.load_state_dict(checkpoint['ensemble'])
+
+        make_test_batches = partial(get_test_batches, cfg, chunk_size=opts.test_chunk)
+        eval_kw = dict(ft=args.features, exact_auc=opts.test_chunk <= 0)
+
+        if opts.async_eval:
+            # The worker loads the test set on its own
+            evaluator = AsyncEvaluator(
+                {mode: nets[mode]['model'] for mode in nets}, make_test_batches, y_test,
+                processes=opts.async_eval_processes, **eval_kw
+            )
+        else:
+            x_test = make_test_batches()
+
+        if opts.profile:
+            profiler = PhaseProfiler(Path(cfg.io['output'], 'profile.json'), window=TEST_FREQ)
+        else:
+            profiler = NullProfiler()
+
+        logger.info('Training started')
+
+        if checkpoint is not None and checkpoint['pending_eval']:
+            # The checkpoint was saved before the evaluation of its last batch finished
+            models = {mode: nets[mode]['model'] for mode in nets if not nets[mode]['over']}
+            if evaluator is None:
+                results = evaluate(models, x_test(), y_test, **eval_kw)
+                update_early_stopping(nets, start, results, args.patience, n_batch)
+            else:
+                evaluator.submit(start, models)
 
-    for i, batch_x in enumerate(x_train, 1):
+        last_checkpoint = start
 
-        if all(nets[mode]['over'] for mode in nets):
-            break
+        batches = iter(x_train)
 
-        for mode in nets:
-            if nets[mode]['over']:
-                continue
+        if opts.compile != 'none' and ensemble is not None:
+            logger.warning('Compilation is not available with --ensemble. Using eager mode')
+        elif opts.compile != 'none':
+            first_batch = next(batches)
+            batches = chain([first_batch], batches)
+
+            for name in nets:
+                example = (first_batch if nets[name]['mode'] == 'with_var'
+                           else flatten_coverage(first_batch))
+                nets[name]['forward_loss'] = compile_forward_loss(
+                    nets[name]['model'], (as_tuple(example), y_train[:cfg.batch_size]),
+                    method=opts.compile
+                )
+
+        for i, batch_x in enumerate(profiler.iterate(batches), start+1):
+            profiler.step()
 
-            nets[mode]['optim'].zero_grad()
+            if evaluator is not None and not opts.async_eval_deterministic:
+                for (j, results) in evaluator.collect(block=False):
+                    update_early_stopping(nets, j, results, args.patience, n_batch)
+
+            if all(nets[mode]['over'] for mode in nets):
+                break
 
             truth_b = y_train[(i-1)*cfg.batch_size:i*cfg.batch_size]
 
-            if mode == 'with_var':
-                pred_b = nets['with_var']['model'](*batch_x)
+            if ensemble is None:
+                train_step(nets, batch_x, truth_b, profiler=profiler)
             else:
-                batch_x_flat = flatten_coverage(batch_x)
-                pred_b = nets['no_var']['model'](*batch_x_flat)
+                train_ensemble_step(ensemble, nets, batch_x, truth_b, profiler=profiler)
 
-            loss = nets[mode]['model'].compute_loss(pred_b, truth_b)
-            loss.backward()
+            if not (
+                    (i % TEST_FREQ == 0) or (i == n_batch)
+            ):
+                continue
 
-            nets[mode]['optim'].step()
+            if ensemble is not None:
+                ensemble.sync()
 
-        if not (
-                (i % TEST_FREQ == 0) or (i == n_batch)
-        ):
-            continue
+            checkpoint_due = (opts.checkpoint_freq > 0 and i < n_batch
+                              and i - last_checkpoint >= opts.checkpoint_freq)
 
-        # Get test results
-        for mode in nets:
-            if nets[mode]['over']:
+            # Get test results
+            if evaluator is None:
+                with profiler.phase('evaluation'):
+                    models = {mode: nets[mode]['model'] for mode in nets if not nets[mode]['over']}
+                    results = evaluate(models, x_test(), y_test, **eval_kw)
+                    update_early_stopping(nets, i, results, args.patience, n_batch)
+
+                if checkpoint_due:
+                    with profiler.phase('checkpoint'):
+                        save_checkpoint(checkpoint_file, i, nets, ensemble, pairs=pairs_hash)
+                    last_checkpoint = i
                 continue
 
-            (pred, test_loss) = make_prediction(
-                nets[mode]['model'], x_test[mode], y_test, args.features
+            with profiler.phase('evaluation'):
+                # Results of the previous evaluation are needed to know which models to evaluate
+                for (j, results) in evaluator.collect():
+                    update_early_stopping(nets, j, results, args.patience, n_batch)
+
+                models = {mode: nets[mode]['model'] for mode in nets if not nets[mode]['over']}
+                if models:
+                    evaluator.submit(i, models)
+
+            if checkpoint_due:
+                # The submitted evaluation is not in the checkpoint: it is run again on resume
+                with profiler.phase('checkpoint'):
+                    save_checkpoint(checkpoint_file, i, nets, ensemble,
+                                    pending_eval=bool(models), pairs=pairs_hash)
+                last_checkpoint = i
+
+        if evaluator is not None:
+            for (j, results) in evaluator.collect():
+                update_early_stopping(nets, j, results, args.patience, n_batch)
+    finally:
+        # Stop the prefetch and evaluation workers even if the training fails
+        if isinstance(x_train, BatchPrefetcher):
+            x_train.close()
+        if evaluator is not None:
+            evaluator.close()
+
+    if isinstance(x_train, BatchPrefetcher):
+        logger.info(x_train.summary())
+
+    if opts.profile:
+        summary = profiler.close()
+        logger.info((
+            f'Profile: {summary["batches_per_sec"]:.2f} batches/s, '
+            f'peak RSS={summary["peak_rss_mb"]:,.0f} MB, '
+            + ', '.join(f'{key}={phase["share"]:.1%}'
+                        for (key, phase) in summary['phases'].items())
+        ))
+
+    save_best_scores(args.fasta,
+                     [(net['mode'], net['seed'], net['best_so_far']) for net in nets.values()],
+                     folder=args.output.parent)
+
+    # The scores are saved: nothing left to resume
+    if checkpoint_file.is_file():
+        checkpoint_file.unlink()
+
+def get_pairs_hash(cfg):
+    return {split: content_hash(path) for (split, path) in cfg.io['pairs'].items()}
+
+def save_checkpoint(path, i, nets, ensemble=None, pending_eval=False, pairs=None):
+    '''
+    Models, optimizers and early stopping state after batch #i (atomic write).
+    With `pending_eval`, the evaluation of batch #i is not in the early stopping
+    state yet and needs to be run again when resuming. `pairs` are the hashes
+    of the pairs files, checked when resuming.
+    '''
+
+    checkpoint = dict(
+        batch=i,
+        pairs=pairs,
+        seed=min(net['seed'] for net in nets.values()),
+        pending_eval=pending_eval,
+        rng=torch.get_rng_state(),
+        ensemble=None if ensemble is None else ensemble.optim.state_dict(),
+        nets={
+            name: dict(
+                model=net['model'].state_dict(),
+                optim=net['optim'].state_dict(),
+                loss=[float(loss) for loss in net['loss']],
+                over=net['over'],
+                best_so_far=net.get('best_so_far')
+            )
+            for (name, net) in nets.items()
+        }
+    )
+
+    tmp_file = Path(path.parent, f'.{path.name}.tmp')
+    torch.save(checkpoint, tmp_file)
+    os.replace(str(tmp_file), str(path))
+
+def restore_checkpoint(checkpoint, nets):
+    if set(checkpoint['nets']) != set(nets):
+        raise ValueError((
+            f'The models in the checkpoint ({", ".join(checkpoint["nets"])}) '
+            f'do not match the current run ({", ".join(nets)})'
+        ))
+
+    for (name, state) in checkpoint['nets'].items():
+        net = nets[name]
+        net['model'].load_state_dict(state['model'])
+        net['optim'].load_state_dict(state['optim'])
+        net['loss'].extend(state['loss'])
+        net['over'] = state['over']
+        if state['best_so_far'] is not None:
+            net['best_so_far'] = state['best_so_far']
+
+    torch.set_rng_state(checkpoint['rng'])
+
+def init_models(cfg, patience, replicates=1, seed=None):
+    '''
+    One pair of models (no_var, with_var) per replicate, named after
+    their mode (and their seed with several replicates)
+    '''
+
+    if seed is None:
+        seed = torch.seed() % 2**31
+
+    nets = {}
+    for replicate_seed in range(seed, seed+replicates):
+        torch.manual_seed(replicate_seed)
+
+        for mode in ['no_var', 'with_var']:
+            name = mode if replicates == 1 else f'{mode}/{replicate_seed}'
+            model = dl_util.initialize_model(
+                '-'.join(cfg.features), cfg.get_input_shapes(), cfg.get_architecture()
+            ).train()
+
+            nets[name] = dict(
+                mode=mode,
+                seed=replicate_seed,
+                model=model,
+                optim=optim.Adam(model.parameters(), lr=cfg.learning_rate),
+                forward_loss=ForwardLoss(model),
+                loss=deque(maxlen=patience),
+                over=False
             )
 
-            losses = nets[mode]['loss']
-            losses.append(test_loss)
+    return nets
 
-            scores = get_scores(y_test_npy, pred)
-            scores.update(mode=mode, batch=i)
+def update_early_stopping(nets, i, results, patience, n_batch):
+    logger = logging.getLogger('<learning>')
 
-            logger.info((
-                f'(Batch #{i:,} / {n_batch:,}, {mode}) '
-                f'accuracy={scores["accuracy"]:.2%}, AUC={scores["AUC"]:.2%}'
-            ))
+    for (mode, (scores, test_loss)) in results.items():
+        losses = nets[mode]['loss']
+        losses.append(test_loss)
 
-            if test_loss <= np.min(losses):
-                nets[mode]['best_so_far'] = [i] + [scores[k] for k in METRICS]
+        scores.update(mode=mode, batch=i)
 
-            if (len(losses) == args.patience
-                and losses[0] <= np.min(losses)):
-                nets[mode]['over'] = True
-                logger.info(f'{mode}: early stopping (best={nets[mode]["best_so_far"]}')
+        logger.info((
+            f'(Batch #{i:,} / {n_batch:,}, {mode}) '
+            f'accuracy={scores["accuracy"]:.2%}, AUC={scores["AUC"]:.2%}'
+        ))
 
-    save_best_scores(args.fasta, [(mode, nets[mode]['best_so_far']) for mode in nets],
-                     folder=args.output.parent)
+        if test_loss <= np.min(losses):
+            nets[mode]['best_so_far'] = [i] + [scores[k] for k in METRICS]
+
+        if (len(losses) == patience
+            and losses[0] <= np.min(losses)):
+            nets[mode]['over'] = True
+            logger.info(f'{mode}: early stopping (best={nets[mode]["best_so_far"]}')
+
+def train_step(nets, batch_x, truth_b, profiler=NullProfiler()):
+    inputs = dict(with_var=as_tuple(batch_x), no_var=as_tuple(flatten_coverage(batch_x)))
+
+    for (name, net) in nets.items():
+        if net['over']:
+            continue
+
+        net['optim'].zero_grad()
+
+        with profiler.phase('forward', name):
+            loss = net['forward_loss'](inputs[net['mode']], truth_b)
+
+        with profiler.phase('backward', name):
+            loss.backward()
+
+        with profiler.phase('step', name):
+            net['optim'].step()
+
+def train_ensemble_step(ensemble, nets, batch_x, truth_b, profiler=NullProfiler()):
+    inputs = dict(with_var=batch_x, no_var=flatten_coverage(batch_x))
+    inputs = [inputs[net['mode']] for net in nets.values()]
+    # Stopped models still go through the vectorized pass
+    # but do not contribute to the gradient anymore
+    active = torch.tensor([not net['over'] for net in nets.values()],
+                          dtype=torch.float32)
+
+    ensemble.optim.zero_grad()
+
+    with profiler.phase('forward', 'ensemble'):
+        losses = ensemble.compute_losses(inputs, truth_b)
+
+    with profiler.phase('backward', 'ensemble'):
+        (losses * active).sum().backward()
+
+    with profiler.phase('step', 'ensemble'):
+        ensemble.optim.step()
+
+class ForwardLoss(nn.Module):
+    '''
+    Forward pass and loss of a model in a single module,
+    so that they can be compiled together
+    '''
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, x, truth):
+        return self.model.compute_loss(self.model(*x), truth)
+
+def compile_forward_loss(model, example, method='script', n_iter=10):
+    '''
+    Compile ForwardLoss(model) with TorchScript (tracing) or torch.compile.
+    The compiled module shares its parameters with `model`.
+    Falls back to eager mode if the compilation or the first run fails,
+    or if the compiled module is not faster.
+    '''
+
+    logger = logging.getLogger('<learning>')
+    eager = ForwardLoss(model)
+
+    try:
+        if method == 'script':
+            compiled = torch.jit.trace(eager, example)
+        else:
+            compiled = torch.compile(eager)
+        # torch.compile is lazy: errors only show up at the first call
+        compiled_time = time_forward_backward(compiled, example, n_iter=n_iter)
+    except Exception as err:
+        logger.warning(f'Compilation with {method} failed ({err}). Using eager mode')
+        model.zero_grad()
+        return eager
+
+    eager_time = time_forward_backward(eager, example, n_iter=n_iter)
+    model.zero_grad()
+
+    speedup = eager_time / compiled_time
+    logger.info((
+        f'Compiled forward/backward pass with {method}: '
+        f'{eager_time*1e3:.1f} ms -> {compiled_time*1e3:.1f} ms '
+        f'({speedup:.2f}x speedup)'
+    ))
+
+    if speedup < 1:
+        logger.info(f'Compilation with {method} is slower than eager mode. Using eager mode')
+        return eager
+
+    return compiled
+
+def time_forward_backward(forward_loss, example, n_iter=10):
+    # warmup
+    forward_loss(*example).backward()
+
+    start = time.perf_counter()
+    for _ in range(n_iter):
+        forward_loss(*example).backward()
+
+    return (time.perf_counter() - start) / n_iter
+
+def as_tuple(inputs):
+    '''
+    Nested tuples of tensors, as expected by the traced modules
+    '''
+
+    if torch.is_tensor(inputs):
+        return inputs
+
+    return tuple(as_tuple(x) for x in inputs)
+
+class ModelEnsemble:
+    '''
+    Models with the same architecture trained as a single vectorized module:
+    the parameters are stacked along a leading axis and the forward/backward
+    passes of all models run at once with torch.func.vmap
+    '''
+
+    def __init__(self, models, learning_rate=1e-3):
+        self.models = models
+        self.base = copy.deepcopy(models[0])
+        (self.params, self.buffers) = stack_module_state(models)
+
+        # Adam is elementwise: a single optimizer over the stacked
+        # parameters is equivalent to one optimizer per model
+        self.optim = optim.Adam(self.params.values(), lr=learning_rate)
+
+        self._compute_losses = vmap(self._compute_loss, in_dims=(0, 0, 0, None),
+                                    randomness='different')
+
+    def _compute_loss(self, params, buffers, x, truth):
+        pred = functional_call(self.base, (params, buffers), tuple(x))
+        return self.base.compute_loss(pred, truth)
+
+    def compute_losses(self, inputs, truth):
+        '''
+        inputs (list): one batch per model, in the same order as self.models
+        '''
+        return self._compute_losses(self.params, self.buffers,
+                                    stack_inputs(inputs), truth)
+
+    @torch.no_grad()
+    def sync(self):
+        '''
+        Copy the stacked weights back to the individual models
+        '''
+        for (i, model) in enumerate(self.models):
+            for (name, tensor) in model.state_dict(keep_vars=True).items():
+                stacked = self.params.get(name, self.buffers.get(name))
+                tensor.copy_(stacked[i])
+
+def stack_inputs(inputs):
+    if torch.is_tensor(inputs[0]):
+        return torch.stack(inputs)
+
+    return [stack_inputs(xi) for xi in zip(*inputs)]
 
 def save_best_scores(fasta, results, folder):
     if 'aloha' in str(fasta).lower():
         print(results)
         return
 
-    output = Path(f'{folder}/scores.csv')
-    if not output.is_file():
-        header = ['genomes', 'samples', 'coverage', 'replicate',
-                  'mode', 'last_batch'] + METRICS
-        with open(output, 'w') as handle:
-            handle.write(','.join(header) + '\n')
-
-    with open(output, 'a') as handle:
-        info = re.split(r'[_\-]', Path(fasta).parent.name)
+    header = ['genomes', 'samples', 'coverage', 'replicate',
+              'mode', 'seed', 'last_batch'] + METRICS
+    info = re.split(r'[_\-]', Path(fasta).parent.name)
 
-        for (mode, scores) in results:
-            data = [info[i] for i in [1, 3, 5, 6]] + [mode] + scores
-            handle.write(','.join(map(str, data)) + '\n')
+    rows = [[info[i] for i in [1, 3, 5, 6]] + [mode, seed] + scores
+            for (mode, seed, scores) in results]
+    save_scores(folder, rows, columns=header)
 
 def flatten_coverage(inputs):
     if len(inputs[0]) == 2:
@@ -158,77 +563,371 @@ def flatten_coverage(inputs):
     else:
         cover = inputs
 
-    template = torch.ones_like(cover[0])
-    flat_cov = [template*xi.mean(axis=2).unsqueeze(-1) for xi in cover]
+    # Broadcast view of the per-sample means: no full size copy
+    means = getattr(cover, 'means', None)
+    if means is None:
+        means = [xi.mean(axis=2, keepdim=True) for xi in cover]
+    flat_cov = [mu.expand_as(xi) for (mu, xi) in zip(means, cover)]
 
     if len(inputs[0]) == 2:
         return [compo, flat_cov]
 
     return flat_cov
             
-def make_prediction(model, x, y, ft='coverage'):
+@torch.no_grad()
+def evaluate(models, test_batches, y, ft='coverage', exact_auc=True):
+    '''
+    Score all models in a single pass over the test chunks.
+    Models are named after their mode, optionally followed by /<seed>
+    '''
 
     if len(ft) == 1:
         ft = ft[0]
     else:
         ft = 'combined'
 
-    model.eval()
-    pred = model(*x)[ft]
-    loss = model.loss_op(pred, y).mean().item()
-    model.train()
+    running = {mode: RunningScores(n_bins=None if exact_auc else 2**16)
+               for mode in models}
+
+    for model in models.values():
+        model.eval()
+
+    start = 0
+    for batch_x in test_batches:
+        inputs = dict(with_var=batch_x, no_var=flatten_coverage(batch_x))
+
+        for (name, model) in models.items():
+            pred = model(*inputs[name.split('/')[0]])[ft]
+            y_chunk = y[start:start+len(pred)]
+            running[name].update(pred, y_chunk, model.loss_op(pred, y_chunk))
+
+        start += len(pred)
+
+    for model in models.values():
+        model.train()
+
+    return {mode: (scores.get_scores(), scores.get_loss())
+            for (mode, scores) in running.items()}
+
+class AsyncEvaluator:
+    '''
+    Evaluation of the models in a background thread or process.
+    The weights are snapshotted at submission (in shared memory for
+    a process) so that training can go on during the evaluation.
+    Results are returned in submission order.
+
+    Call `close` once done: a process worker is not a daemon.
+    '''
+
+    def __init__(self, models, make_test_batches, y, ft='coverage',
+                 exact_auc=True, processes=False):
+        if processes:
+            (make_queue, make_worker) = (mp.Queue, mp.Process)
+        else:
+            (make_queue, make_worker) = (queue.Queue, threading.Thread)
+
+        self.inputs = make_queue()
+        self.outputs = make_queue()
+        self.pending = 0
+
+        self.worker = make_worker(
+            target=eval_worker,
+            args=(copy.deepcopy(models), make_test_batches, y, ft, exact_auc,
+                  self.inputs, self.outputs),
+            daemon=not processes # CompositionGenerator needs to start its own pool
+        )
+        self.worker.start()
+
+    def submit(self, i, models):
+        snapshot = {
+            mode: {key: val.detach().clone() for (key, val) in model.state_dict().items()}
+            for (mode, model) in models.items()
+        }
+        self.inputs.put((i, snapshot))
+        self.pending += 1
+
+    def collect(self, block=True):
+        '''
+        Results of the finished evaluations, as (batch, results) tuples.
+        If block is set, wait for all pending evaluations.
+        '''
+
+        finished = []
+
+        while self.pending > 0:
+            try:
+                result = self.outputs.get(timeout=1) if block else self.outputs.get_nowait()
+            except queue.Empty:
+                if not self.worker.is_alive():
+                    raise RuntimeError('Evaluation worker died unexpectedly')
+                if not block:
+                    break
+                continue
+
+            if isinstance(result, Exception):
+                raise result
+
+            finished.append(result)
+            self.pending -= 1
+
+        return finished
+
+    def close(self):
+        '''
+        Stop the worker once the pending evaluations are done
+        '''
+
+        if self.worker.is_alive():
+            self.inputs.put(None)
+            self.worker.join()
+
+def eval_worker(models, make_test_batches, y, ft, exact_auc, inputs, outputs):
+    try:
+        x_test = make_test_batches()
+
+        while parent_alive():
+            try:
+                task = inputs.get(timeout=1)
+            except queue.Empty:
+                continue
+
+            if task is None:
+                return
+
+            (i, snapshot) = task
+            for (mode, state) in snapshot.items():
+                models[mode].load_state_dict(state)
+
+            results = evaluate({mode: models[mode] for mode in snapshot},
+                               x_test(), y, ft=ft, exact_auc=exact_auc)
+            outputs.put((i, results))
+
+    except Exception as err:
+        outputs.put(err)
+
+class RunningScores:
+    '''
+    Test metrics accumulated over chunks of predictions.
+    With `n_bins`, the AUC is computed from per-class histograms
+    of the predicted scores (pairs in the same bin count as ties)
+    and the memory does not depend on the test set size.
+    Otherwise, the scores are kept and the AUC is exact.
+    '''
+
+    def __init__(self, n_bins=2**16):
+        self.n_bins = n_bins
+        self.loss_sum = 0
+        self.confusion = np.zeros((2, 2), dtype=np.int64)
+
+        if n_bins is None:
+            self.pred = [[], []]
+        else:
+            self.hist = np.zeros((2, n_bins), dtype=np.int64)
+
+    def update(self, pred, truth, loss):
+        pred = pred.numpy()[:, 0]
+        truth = truth.numpy()[:, 0].astype(int)
+        pred_bin = (pred > 0.5).astype(int)
+
+        self.loss_sum += loss.sum().item()
+        self.confusion += np.bincount(2*truth + pred_bin, minlength=4).reshape(2, 2)
+
+        if self.n_bins is None:
+            for label in [0, 1]:
+                self.pred[label].append(pred[truth == label])
+        else:
+            bins = np.minimum((pred * self.n_bins).astype(int), self.n_bins-1)
+            self.hist += np.bincount(truth*self.n_bins + bins,
+                                     minlength=2*self.n_bins).reshape(2, -1)
+
+    def get_loss(self):
+        return self.loss_sum / self.confusion.sum()
+
+    def get_auc(self):
+        if self.n_bins is None:
+            pred = [np.concatenate(p) for p in self.pred]
+            (values, labels) = (np.concatenate(pred), np.repeat([0, 1], [len(p) for p in pred]))
+            (_, bins) = np.unique(values, return_inverse=True)
+            hist = np.stack([np.bincount(bins[labels == label], minlength=bins.max()+1)
+                             for label in [0, 1]])
+        else:
+            hist = self.hist
+
+        (neg, pos) = hist
+        neg_below = np.cumsum(neg) - neg
+
+        return np.sum(pos * (neg_below + neg/2)) / (neg.sum() * pos.sum())
+
+    def get_scores(self):
+        ((tn, fp), (fn, tp)) = self.confusion
+
+        return dict(
+            accuracy=(tp+tn) / self.confusion.sum(),
+            AUC=self.get_auc(),
+            precision=tp / max(tp+fp, 1),
+            recall=tp / max(tp+fn, 1),
+            TN=tn,
+            TP=tp,
+            FN=fn,
+            FP=fp,
+        )
 
-    return (pred.detach().numpy(), loss)
-    
 def get_truth(pairs_file):
-    ctg_names = np.load(pairs_file)['sp']
+    '''
+    Labels of the pairs (1 if both fragments come from the same contig).
+    The contig names are mapped to integer codes to compare them in bulk,
+    and the labels are saved next to the pairs file to be reused later.
+    '''
 
-    sim = all('|' in ctg for ctg in ctg_names[:, 0])
+    labels_file = Path(pairs_file).with_suffix('.labels.npy')
 
-    if sim:
-        truth = np.zeros(len(ctg_names))
-        for i, (ctg1, ctg2) in enumerate(ctg_names):
-            truth[i] = ctg1 == ctg2
+    if (labels_file.is_file()
+        and labels_file.stat().st_mtime >= Path(pairs_file).stat().st_mtime):
+        truth = np.load(labels_file)
     else:
-        truth = ctg_names[:, 0] == ctg_names[:, 1]
+        ctg_names = np.load(pairs_file, mmap_mode='r')['sp']
+        (_, codes) = np.unique(ctg_names, return_inverse=True)
+        codes = codes.reshape(ctg_names.shape)
+
+        truth = (codes[:, 0] == codes[:, 1]).astype(np.float32)
+        np.save(labels_file, truth)
 
-    return torch.from_numpy(truth.astype(np.float32)[:, None])
+    return torch.from_numpy(truth[:, None])
 
-def get_composition_generator(cfg, mode):
+def get_composition_generator(cfg, mode, batch_size=None):
     pairs = cfg.io['pairs'][mode]
 
+    if batch_size is None:
+        batch_size = cfg.batch_size * (mode=='train')
+
     return CompositionGenerator(
         pairs, cfg.io['filt_fasta'],
-        batch_size=cfg.batch_size * (mode=='train'),
+        batch_size=batch_size,
         kmer=cfg.kmer, rc=True, norm=False
     )
 
-def get_coverage_generator(cfg, mode):
+def get_coverage_generator(cfg, mode, with_means=True, batch_size=None, load_batch=None):
     pairs = cfg.io['pairs'][mode]
+    generator_class = CoverageMeansGenerator if with_means else CoverageGenerator
 
-    return CoverageGenerator(
+    if batch_size is None:
+        batch_size = cfg.batch_size * (mode=='train')
+
+    return generator_class(
         pairs,
         cfg.io['h5'],
-        batch_size=cfg.batch_size * (mode=='train'),
-        load_batch=cfg.load_batch,
+        batch_size=batch_size,
+        load_batch=load_batch or cfg.load_batch,
         wsize=cfg.wsize, wstep=cfg.wstep
     )
 
-def get_scores(truth, pred):
-    pred_bin = pred.round()
-    summary = confusion_matrix(truth, pred_bin)
-
-    return dict(
-        accuracy=accuracy_score(truth, pred_bin),
-        AUC=roc_auc_score(truth, pred),
-        precision=precision_score(truth, pred_bin),
-        recall=recall_score(truth, pred_bin),
-        TN=summary[0, 0],
-        TP=summary[1, 1],
-        FN=summary[1, 0],
-        FP=summary[0, 1],
+class CoverageBatch(tuple):
+    '''
+    Coverage batch (x1, x2) with the per-sample window means
+    of each fragment as a compact side tensor in `means`
+    '''
+
+    def __new__(cls, inputs, means):
+        batch = super().__new__(cls, inputs)
+        batch.means = means
+
+        return batch
+
+    def __getnewargs__(self):
+        return (tuple(self), self.means)
+
+class CoverageMeansGenerator(CoverageGenerator):
+    '''
+    CoverageGenerator also yielding the per-sample window means,
+    computed once for each loaded chunk
+    '''
+
+    def load(self):
+        super().load()
+        self.means = [x.mean(axis=2, keepdims=True) for x in (self.x1, self.x2)]
+
+    def __next__(self):
+        inputs = super().__next__()
+
+        idx_inf = ((self.i-1) % self.load_batch) * self.batch_size
+        idx_sup = idx_inf + self.batch_size
+        means = tuple(torch.from_numpy(mu[idx_inf:idx_sup]) for mu in self.means)
+
+        return CoverageBatch(inputs, means)
+
+def get_test_batches(cfg, chunk_size=0):
+    '''
+    Callable returning an iterable over the test set.
+    If chunk_size is 0, the whole test set is loaded once and kept in memory.
+    Otherwise, it is streamed from disk in chunks of `chunk_size` pairs
+    at each evaluation, with the same generators rewound at each pass.
+    '''
+
+    if chunk_size <= 0:
+        generators = [get_coverage_generator(cfg, 'test')]
+        if len(cfg.features) > 1:
+            generators.insert(0, get_composition_generator(cfg, 'test'))
+
+        x_test = [next(zip(*generators)) if len(generators) > 1 else next(generators[0])]
+
+        return lambda: x_test
+
+    # Include the last incomplete chunk
+    n_chunks = -(-dl_util.get_npy_lines(cfg.io['pairs']['test']) // chunk_size)
+
+    generators = [get_coverage_generator(cfg, 'test', batch_size=chunk_size, load_batch=1)]
+    if len(cfg.features) > 1:
+        generators.insert(0, get_composition_generator(cfg, 'test', batch_size=chunk_size))
+
+    for generator in generators:
+        # CompositionGenerator closes its pool after its last batch:
+        # stop one chunk before so that it can be reused
+        generator.n_batches = n_chunks + 1
+
+    def stream():
+        for generator in generators:
+            generator.i = 0
+
+        if len(generators) > 1:
+            return islice(zip(*generators), n_chunks)
+        return islice(generators[0], n_chunks)
+
+    return stream
+
+def get_train_batches(cfg, opts, start=0):
+    '''
+    Training batches, starting from batch #`start` when resuming
+    '''
+
+    factories = [partial(get_coverage_generator, cfg, 'train')]
+    if len(cfg.features) > 1:
+        factories.insert(0, partial(get_composition_generator, cfg, 'train'))
+
+    if opts.prefetch <= 0:
+        generators = [factory() for factory in factories]
+
+        # Only the H5 chunk containing `start` is loaded again
+        for generator in generators:
+            generator.i = start - start % cfg.load_batch
+            for _ in range(start % cfg.load_batch):
+                next(generator)
+
+        if len(generators) > 1:
+            return zip(*generators)
+        return generators[0]
+
+    n_batches = max(1, dl_util.get_npy_lines(cfg.io['pairs']['train']) // cfg.batch_size)
+
+    return BatchPrefetcher(
+        factories, n_batches,
+        chunk_size=cfg.load_batch,
+        queue_depth=opts.prefetch,
+        workers=opts.prefetch_workers,
+        processes=opts.prefetch_processes,
+        start=start
     )
 
 
+
 if __name__ == '__main__':
     main()
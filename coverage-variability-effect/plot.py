@@ -2,11 +2,14 @@
 
 import re
 import sys
+from pathlib import Path
 
 import pandas as pd
 import seaborn as sns
 import matplotlib.pyplot as plt
 
+from results import load_scores
+
 sns.set(**{'context': 'paper', 'style': 'darkgrid'})
 FS = 16
 
@@ -17,10 +20,16 @@ RC = {'axes.labelsize': FS+2,
 
 plt.rcParams.update(**RC)
 
-data = pd.read_csv(sys.argv[1]).set_index(['genomes', 'samples', 'coverage',
-                                           'replicate', 'mode', 'last_batch'])
+# Results folder (or its scores.csv), including the shards not compacted yet
+folder = Path(sys.argv[1])
+if folder.suffix == '.csv':
+    folder = folder.parent
+
+data = load_scores(folder).set_index(['genomes', 'samples', 'coverage',
+                                     'replicate', 'mode', 'last_batch'])
 data = (data
-        .drop(columns=['TP', 'TN', 'FP', 'FN'])
+        # replicates with different seeds are pooled
+        .drop(columns=['TP', 'TN', 'FP', 'FN', 'seed'], errors='ignore')
         .rename_axis(columns='metric').stack().rename('score')
         .reset_index())
 
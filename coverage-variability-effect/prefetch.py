@@ -0,0 +1,184 @@
+'''
+Background prefetching of training batches for the coverage variability experiment
+'''
+
+import time
+import queue
+import threading
+from multiprocessing import parent_process
+
+import torch.multiprocessing as mp
+
+
+class BatchPrefetcher:
+    '''
+    Bounded prefetching of the batches built by CoCoNet's generators.
+
+    Each worker builds its own generators (with `factories`) and produces
+    contiguous chunks of `chunk_size` batches in a round-robin fashion.
+    Batches are therefore returned in the same order as the sequential
+    generators. `chunk_size` needs to be a multiple of the CoverageGenerator
+    `load_batch` so that each chunk starts with a fresh H5 load.
+    Batches before `start` are skipped (e.g. when resuming a training).
+
+    The time the consumer spends waiting for data and computing between two
+    batches is recorded in `wait_time` and `compute_time`.
+
+    Use it as a context manager (or call `close`) so that the workers
+    are stopped if the consumer fails: process workers are not daemons.
+    '''
+
+    def __init__(self, factories, n_batches, chunk_size=1, queue_depth=4,
+                 workers=1, processes=False, start=0):
+        self.n_batches = n_batches
+        self.chunk_size = chunk_size
+        self.n_workers = workers
+        self.start = start
+        # Chunks are aligned on the chunk containing `start`
+        self.first_chunk = start - start % chunk_size
+        self.i = start
+
+        self.wait_time = 0
+        self.compute_time = 0
+        self._last = None
+
+        if processes:
+            (make_queue, make_worker) = (mp.Queue, mp.Process)
+            self.stop = mp.Event()
+        else:
+            (make_queue, make_worker) = (queue.Queue, threading.Thread)
+            self.stop = threading.Event()
+
+        self.queues = [make_queue(maxsize=queue_depth) for _ in range(workers)]
+        self.workers = [
+            make_worker(
+                target=prefetch_worker,
+                args=(factories, rank, workers, n_batches, chunk_size, output, self.stop,
+                      start),
+                daemon=not processes # CompositionGenerator needs to start its own pool
+            )
+            for (rank, output) in enumerate(self.queues)
+        ]
+
+        for worker in self.workers:
+            worker.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __iter__(self):
+        return self
+
+    def __len__(self):
+        return self.n_batches
+
+    def __next__(self):
+        if self.i >= self.n_batches:
+            self.close()
+            raise StopIteration()
+
+        now = time.perf_counter()
+        if self._last is not None:
+            self.compute_time += now - self._last
+
+        rank = ((self.i - self.first_chunk) // self.chunk_size) % self.n_workers
+        batch = self._get(rank)
+
+        self._last = time.perf_counter()
+        self.wait_time += self._last - now
+
+        if isinstance(batch, Exception):
+            self.close()
+            raise batch
+
+        self.i += 1
+
+        return batch
+
+    def _get(self, rank):
+        while True:
+            try:
+                return self.queues[rank].get(timeout=1)
+            except queue.Empty:
+                if not self.workers[rank].is_alive():
+                    self.close()
+                    raise RuntimeError(f'Prefetch worker #{rank} died unexpectedly')
+
+    def close(self):
+        '''
+        Stop the workers (e.g. after early stopping)
+        '''
+
+        self.stop.set()
+
+        for (worker, output) in zip(self.workers, self.queues):
+            # Unblock workers waiting on a full queue
+            while worker.is_alive():
+                try:
+                    output.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+                worker.join(timeout=0.1)
+
+    def summary(self):
+        total = max(self.wait_time + self.compute_time, 1e-9)
+
+        return (
+            f'{self.i-self.start:,} batches prefetched by {self.n_workers} worker(s): '
+            f'data wait={self.wait_time:.1f}s ({self.wait_time/total:.1%}), '
+            f'compute={self.compute_time:.1f}s ({self.compute_time/total:.1%})'
+        )
+
+def prefetch_worker(factories, rank, n_workers, n_batches, chunk_size, output, stop, start=0):
+    '''
+    Build the batches of the chunks assigned to worker #`rank`
+    and put them in the bounded `output` queue
+    '''
+
+    try:
+        generators = [factory() for factory in factories]
+        first_chunk = start - start % chunk_size
+
+        for chunk_start in range(first_chunk + rank*chunk_size, n_batches, n_workers*chunk_size):
+            for generator in generators:
+                generator.i = chunk_start
+
+            for j in range(chunk_start, min(chunk_start+chunk_size, n_batches)):
+                batch = tuple(next(generator) for generator in generators)
+                if j < start:
+                    continue
+                if len(batch) == 1:
+                    batch = batch[0]
+
+                if not put_unless_stopped(output, batch, stop):
+                    return
+
+        # Keep the (shared memory) batches alive until the consumer is done
+        while not stop.wait(1):
+            if not parent_alive():
+                return
+
+    except Exception as err:
+        put_unless_stopped(output, err, stop)
+
+def put_unless_stopped(output, item, stop):
+    while not stop.is_set() and parent_alive():
+        try:
+            output.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+
+    return False
+
+def parent_alive():
+    '''
+    False if the worker is a process whose parent exited (e.g. killed before closing the prefetcher)
+    '''
+
+    parent = parent_process()
+
+    return parent is None or parent.is_alive()
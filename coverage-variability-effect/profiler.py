@@ -0,0 +1,137 @@
+'''
+Per-phase profiling of the coverage variability training loop
+'''
+
+import os
+import json
+import time
+import threading
+from pathlib import Path
+from contextlib import contextmanager, nullcontext
+from collections import defaultdict
+
+
+class NullProfiler:
+    '''
+    Profiler interface doing nothing, used when profiling is disabled
+    '''
+
+    _context = nullcontext()
+
+    def phase(self, name, mode='all'):
+        return self._context
+
+    def iterate(self, batches):
+        return batches
+
+    def step(self):
+        pass
+
+    def close(self):
+        pass
+
+class PhaseProfiler(NullProfiler):
+    '''
+    Time spent in each phase of the training loop (data, forward, backward,
+    step, evaluation, checkpoint), with RSS sampled in the background.
+    Phases are recorded per mode if given (e.g. forward/no_var), else under 'all'.
+    Totals are also reported every `window` batches, and everything
+    is saved as json in `output` when closing the profiler.
+    '''
+
+    def __init__(self, output, window=100, rss_interval=1.0):
+        self.output = Path(output)
+        self.window = window
+
+        self.totals = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.window_totals = defaultdict(float)
+        self.trace = []
+
+        self.n_batches = 0
+        self.start = time.perf_counter()
+        self.window_start = self.start
+
+        self.rss = []
+        self.stop = threading.Event()
+        self.sampler = threading.Thread(target=self.sample_rss, args=(rss_interval,),
+                                        daemon=True)
+        self.sampler.start()
+
+    @contextmanager
+    def phase(self, name, mode='all'):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, mode, time.perf_counter() - start)
+
+    def add(self, name, mode, duration):
+        key = f'{name}/{mode}'
+        self.totals[key] += duration
+        self.calls[key] += 1
+        self.window_totals[key] += duration
+
+    def iterate(self, batches):
+        batches = iter(batches)
+
+        while True:
+            start = time.perf_counter()
+            try:
+                batch = next(batches)
+            except StopIteration:
+                return
+            self.add('data', 'all', time.perf_counter() - start)
+
+            yield batch
+
+    def step(self):
+        self.n_batches += 1
+
+        if self.n_batches % self.window != 0:
+            return
+
+        now = time.perf_counter()
+        self.trace.append(dict(
+            batch=self.n_batches,
+            elapsed=now - self.start,
+            batches_per_sec=self.window / (now - self.window_start),
+            rss_mb=get_rss(),
+            phases=dict(self.window_totals)
+        ))
+        self.window_start = now
+        self.window_totals.clear()
+
+    def sample_rss(self, interval):
+        while not self.stop.wait(interval):
+            self.rss.append((time.perf_counter() - self.start, get_rss()))
+
+    def close(self):
+        self.stop.set()
+        self.sampler.join()
+
+        elapsed = time.perf_counter() - self.start
+        summary = dict(
+            batches=self.n_batches,
+            elapsed=elapsed,
+            batches_per_sec=self.n_batches / elapsed,
+            peak_rss_mb=max((rss for (_, rss) in self.rss), default=get_rss()),
+            phases={key: dict(total=total, calls=self.calls[key], share=total/elapsed)
+                    for (key, total) in sorted(self.totals.items())}
+        )
+
+        with open(self.output, 'w') as handle:
+            json.dump(dict(summary=summary, trace=self.trace, rss=self.rss),
+                      handle, indent=2)
+
+        return summary
+
+def get_rss():
+    '''
+    Current resident memory of the process in MB
+    '''
+
+    with open('/proc/self/statm') as handle:
+        pages = int(handle.read().split()[1])
+
+    return pages * os.sysconf('SC_PAGE_SIZE') / 2**20
@@ -0,0 +1,83 @@
+'''
+Concurrency-safe storage of the coverage variability scores.
+
+Each run writes its scores in its own shard file (results/scores.d/*.csv),
+and the shards are periodically compacted into results/scores.csv.
+Compaction and reads are synchronized with a lock file.
+'''
+
+import os
+import time
+import fcntl
+import socket
+from pathlib import Path
+from contextlib import contextmanager
+
+import pandas as pd
+
+
+SHARDS = 'scores.d'
+
+
+@contextmanager
+def locked(folder, exclusive=True):
+    with open(Path(folder, '.scores.lock'), 'w') as handle:
+        fcntl.flock(handle, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(handle, fcntl.LOCK_UN)
+
+def save_scores(folder, rows, columns):
+    '''
+    Write the scores of one run in a new shard (atomically)
+    '''
+
+    shards = Path(folder, SHARDS)
+    shards.mkdir(parents=True, exist_ok=True)
+
+    name = f'{socket.gethostname()}-{os.getpid()}-{time.time_ns()}'
+    tmp_file = Path(shards, f'.{name}.tmp')
+
+    pd.DataFrame(rows, columns=columns).to_csv(tmp_file, index=False)
+    os.replace(str(tmp_file), str(Path(shards, f'{name}.csv')))
+
+def load_scores(folder):
+    '''
+    All scores: compacted table and shards not compacted yet
+    '''
+
+    if not Path(folder).is_dir():
+        return pd.DataFrame()
+
+    with locked(folder, exclusive=False):
+        tables = [Path(folder, 'scores.csv')] + sorted(Path(folder, SHARDS).glob('*.csv'))
+        tables = [pd.read_csv(table) for table in tables if table.is_file()]
+
+    if not tables:
+        return pd.DataFrame()
+
+    return pd.concat(tables, ignore_index=True)
+
+def compact_scores(folder):
+    '''
+    Merge the shards into scores.csv
+    '''
+
+    with locked(folder):
+        shards = sorted(Path(folder, SHARDS).glob('*.csv'))
+
+        if not shards:
+            return
+
+        output = Path(folder, 'scores.csv')
+        tables = [output] if output.is_file() else []
+        scores = pd.concat([pd.read_csv(table) for table in tables + shards],
+                           ignore_index=True)
+
+        tmp_file = Path(folder, '.scores.csv.tmp')
+        scores.to_csv(tmp_file, index=False)
+        os.replace(str(tmp_file), str(output))
+
+        for shard in shards:
+            shard.unlink()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+
+'''
+Run the coverage variability experiment on all camisim simulations,
+with several datasets processed at the same time within a core budget
+'''
+
+import os
+import re
+import sys
+import time
+import shlex
+import random
+import argparse
+import subprocess
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import pandas as pd
+
+from results import load_scores, compact_scores
+
+
+def parse_args():
+    '''
+    '''
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('data', type=str, help='Folder with the camisim simulations')
+    parser.add_argument('--cores', type=int, default=os.cpu_count(),
+                        help='Total number of cores available for the sweep')
+    parser.add_argument('--threads', type=int, default=50, help='Number of threads per run')
+    parser.add_argument('--results', type=str, default='results')
+    parser.add_argument('--opts', type=str, default='',
+                        help='Additional options for main.py (e.g. "--ensemble --prefetch 4")')
+    parser.add_argument('--seed', type=int, default=None, help='Seed to shuffle the datasets')
+    args = parser.parse_args()
+
+    return args
+
+def get_datasets(data, seed=None):
+    folders = [f for f in Path(data).glob('camisim*') if re.search(r'\d$', f.name)]
+    random.Random(seed).shuffle(folders)
+
+    return folders
+
+def get_sim_info(folder):
+    # (genomes, samples, coverage, replicate), as in main.save_best_scores
+    info = re.split(r'[_\-]', Path(folder).name)
+
+    return tuple(info[i] for i in [1, 3, 5, 6])
+
+def get_done(results):
+    '''
+    Simulations with scores for both modes in the results folder
+    '''
+
+    scores = load_scores(results)
+
+    if scores.empty:
+        return set()
+
+    scores = scores.astype(str)
+    n_modes = scores.groupby(['genomes', 'samples', 'coverage', 'replicate'])['mode'].nunique()
+
+    return set(n_modes.index[n_modes >= 2])
+
+def run_one(folder, threads=1, results='results', opts=''):
+    '''
+    Run main.py on one simulation and return its wall time and peak RSS
+    '''
+
+    cmd = [
+        sys.executable, str(Path(__file__).parent / 'main.py'), 'run',
+        '--threads', str(threads),
+        '--fasta', f'{folder}/assembly.fasta',
+        '--h5', f'{folder}/coverage_contigs.h5',
+        '--output', f'{results}/output-{folder.name}',
+        '--features', 'coverage',
+        # Continue from the last checkpoint of an interrupted sweep
+        '--resume'
+    ] + shlex.split(opts)
+
+    # Keep the math libraries within the thread budget of the run
+    env = dict(os.environ, **{var: str(threads) for var in
+                              ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']})
+
+    log_file = Path(results, 'logs', f'{folder.name}.log')
+    log_file.parent.mkdir(parents=True, exist_ok=True)
+
+    start = time.perf_counter()
+    with open(log_file, 'w') as handle:
+        proc = subprocess.Popen(cmd, stdout=handle, stderr=subprocess.STDOUT, env=env)
+        # rusage of the child: ru_maxrss is the peak RSS (in kB)
+        # of the largest process of the run
+        (_, status, rusage) = os.wait4(proc.pid, 0)
+        proc.returncode = (os.WEXITSTATUS(status) if os.WIFEXITED(status)
+                           else -os.WTERMSIG(status))
+    wall_time = time.perf_counter() - start
+
+    return dict(
+        dataset=folder.name,
+        threads=threads,
+        wall_time=round(wall_time, 1),
+        peak_rss_mb=round(rusage.ru_maxrss / 2**10, 1),
+        cpu_time=round(rusage.ru_utime + rusage.ru_stime, 1),
+        returncode=proc.returncode
+    )
+
+def main():
+    '''
+    '''
+
+    args = parse_args()
+
+    Path(args.results).mkdir(exist_ok=True)
+
+    done = get_done(args.results)
+    datasets = [f for f in get_datasets(args.data, seed=args.seed)
+                if get_sim_info(f) not in done]
+
+    n_parallel = max(1, args.cores // args.threads)
+    print(f'{len(done)} simulations already processed, {len(datasets)} remaining. '
+          f'Running {n_parallel} at a time with {args.threads} threads each')
+
+    runs_file = Path(args.results, 'sweep-runs.csv')
+
+    with ThreadPoolExecutor(n_parallel) as executor:
+        jobs = [executor.submit(run_one, folder, threads=args.threads,
+                                results=args.results, opts=args.opts)
+                for folder in datasets]
+
+        for (i, job) in enumerate(as_completed(jobs), 1):
+            run = job.result()
+            print(f'[{i}/{len(jobs)}] {run["dataset"]}: {run["wall_time"]:,}s, '
+                  f'{run["peak_rss_mb"]:,} MB (exit code {run["returncode"]})')
+
+            pd.DataFrame([run]).to_csv(runs_file, mode='a', index=False,
+                                       header=not runs_file.is_file())
+
+    compact_scores(args.results)
+
+if __name__ == '__main__':
+    main()
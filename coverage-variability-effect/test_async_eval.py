@@ -0,0 +1,104 @@
+'''
+Asynchronous evaluation with the combined (composition and coverage) features.
+Run with `python -m pytest test_async_eval.py` in this folder
+'''
+
+from types import SimpleNamespace
+from functools import partial
+
+import numpy as np
+import h5py
+import pytest
+from coconet import dl_util
+
+from main import AsyncEvaluator, evaluate, get_test_batches, get_truth
+
+FRAG_LEN = 64
+N_SAMPLES = 3
+
+
+def make_cfg(folder, n_contigs=4, n_pairs=50, seed=0):
+    '''
+    Small test set: random contigs, their coverage and fragment pairs
+    '''
+
+    rng = np.random.default_rng(seed)
+    names = [f'ctg_{i}' for i in range(n_contigs)]
+
+    with open(f'{folder}/contigs.fasta', 'w') as handle:
+        for name in names:
+            handle.write(f'>{name}\n{"".join(rng.choice(list("ACGT"), 500))}\n')
+
+    with h5py.File(f'{folder}/coverage.h5', 'w') as handle:
+        for name in names:
+            handle.create_dataset(name, data=rng.poisson(10, (N_SAMPLES, 500)).astype(np.float32))
+
+    pairs = np.zeros((n_pairs, 2), dtype=[('sp', '<U10'), ('start', 'u4'), ('end', 'u4')])
+    pairs['sp'] = rng.choice(names, (n_pairs, 2))
+    pairs['start'] = rng.integers(0, 500-FRAG_LEN, (n_pairs, 2))
+    pairs['end'] = pairs['start'] + FRAG_LEN
+    np.save(f'{folder}/pairs_test.npy', pairs)
+
+    return SimpleNamespace(
+        io=dict(pairs=dict(test=f'{folder}/pairs_test.npy'),
+                filt_fasta=f'{folder}/contigs.fasta', h5=f'{folder}/coverage.h5'),
+        features=['coverage', 'composition'],
+        kmer=4, batch_size=16, load_batch=10, wsize=16, wstep=8
+    )
+
+def make_models(cfg):
+    input_shapes = dict(composition=136,
+                        coverage=((FRAG_LEN-cfg.wsize)//cfg.wstep + 1, N_SAMPLES))
+    architecture = dict(
+        composition=dict(neurons=[32, 16]),
+        coverage=dict(neurons=[32, 16], n_filters=8, kernel_size=4, conv_stride=2),
+        merge=dict(neurons=8)
+    )
+
+    return {mode: dl_util.initialize_model('composition-coverage', input_shapes, architecture)
+            for mode in ['with_var', 'no_var']}
+
+def failing_test_batches():
+    raise OSError('missing test set')
+
+@pytest.mark.parametrize('chunk_size', [0, 16])
+@pytest.mark.parametrize('processes', [False, True])
+def test_combined_features(tmp_path, processes, chunk_size):
+    cfg = make_cfg(tmp_path)
+    y = get_truth(cfg.io['pairs']['test'])
+    models = make_models(cfg)
+    make_test_batches = partial(get_test_batches, cfg, chunk_size=chunk_size)
+
+    expected = evaluate(models, make_test_batches()(), y, ft=cfg.features)
+
+    evaluator = AsyncEvaluator(models, make_test_batches, y, ft=cfg.features,
+                               processes=processes)
+    try:
+        evaluator.submit(1, models)
+        evaluator.submit(2, {'no_var': models['no_var']})
+        results = evaluator.collect()
+    finally:
+        evaluator.close()
+
+    assert [i for (i, _) in results] == [1, 2]
+    assert list(results[1][1]) == ['no_var']
+    for mode in models:
+        assert results[0][1][mode][1] == pytest.approx(expected[mode][1])
+    # The test set is read again from the start at each evaluation
+    assert results[1][1]['no_var'][1] == pytest.approx(expected['no_var'][1])
+    assert not evaluator.worker.is_alive()
+
+@pytest.mark.parametrize('processes', [False, True])
+def test_failed_test_set(tmp_path, processes):
+    cfg = make_cfg(tmp_path)
+    y = get_truth(cfg.io['pairs']['test'])
+
+    evaluator = AsyncEvaluator(make_models(cfg), failing_test_batches, y,
+                               ft=cfg.features, processes=processes)
+    evaluator.submit(1, make_models(cfg))
+
+    with pytest.raises(OSError, match='missing test set'):
+        evaluator.collect()
+
+    evaluator.close()
+    assert not evaluator.worker.is_alive()
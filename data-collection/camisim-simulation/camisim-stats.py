@@ -1,13 +1,16 @@
 #!/usr/bin/env python3
 
+import sys
 import argparse
 import re
 from pathlib import Path
 
-import numpy as np
 import pandas as pd
 import h5py
 
+sys.path.append(str(Path(__file__).resolve().parents[2] / 'common'))
+from coverage_h5 import get_lengths, get_moments
+
 
 def parse_args():
     '''
@@ -49,15 +52,10 @@ def summarize_metadata(path, csv=False):
 
 def summarize_abundance(path, csv=False):
     with h5py.File(path, 'r') as handle:
-        n_contigs = len(handle)
-        n_samples = next(iter(handle.values())).shape[0]
-
-        coverage = np.zeros((n_contigs, n_samples))
-        ctg_sizes = np.zeros(n_contigs)
+        (coverage, _) = get_moments(handle)
+        ctg_sizes = get_lengths(handle).astype(float)
 
-        for i, cov in enumerate(handle.values()):
-            coverage[i] = cov[:].sum(axis=1)
-            ctg_sizes[i] = cov.shape[1]
+    (n_contigs, n_samples) = coverage.shape
 
     xcoverage = coverage.sum(axis=0) / ctg_sizes[:, None].sum()
     gt2kb = ctg_sizes >= 2048
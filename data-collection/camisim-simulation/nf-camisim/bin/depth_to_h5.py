@@ -4,7 +4,8 @@ import argparse
 from pathlib import Path
 
 import pandas as pd
-import h5py
+
+from coverage_h5 import coverage_writer
 
 
 def parse_args():
@@ -13,6 +14,7 @@ def parse_args():
     parser.add_argument('--metadata', type=str)
     parser.add_argument('--genome-sizes', type=str)    
     parser.add_argument('--n-samples', type=int)    
+    parser.add_argument('--layout', type=str, default='datasets', choices=['datasets', 'ragged'])
     args = parser.parse_args()
 
     return args
@@ -26,8 +28,8 @@ def main():
     info = metadata.groupby("V_id").agg(list)
     sizes = pd.read_csv(args.genome_sizes, index_col=0).iloc[:, 0]
 
-    cov_vir_h5 = h5py.File("coverage_virus.h5","w")
-    cov_ctg_h5 = h5py.File("coverage_contigs.h5","w")
+    cov_vir_h5 = coverage_writer("coverage_virus.h5", args.n_samples, layout=args.layout, dtype=None)
+    cov_ctg_h5 = coverage_writer("coverage_contigs.h5", args.n_samples, layout=args.layout, dtype=None)
 
     for filename in Path('.').glob('*.txt'):
         virus = filename.stem
@@ -46,10 +48,10 @@ def main():
                     .fillna(0)
                     .to_numpy().T)
 
-        cov_vir_h5.create_dataset(virus, data=coverage)
+        cov_vir_h5.append(virus, coverage)
 
         for ctg, start, end in zip(*info.loc[virus, ["C_id", "start", "end"]]):
-            cov_ctg_h5.create_dataset(ctg, data=coverage[:,start-1:end])
+            cov_ctg_h5.append(ctg, coverage[:,start-1:end])
 
     cov_ctg_h5.close()
     cov_vir_h5.close()
@@ -1,4 +1,5 @@
 import os
+import sys
 from pathlib import Path
 
 from sklearn.metrics import adjusted_rand_score, homogeneity_score, completeness_score
@@ -11,6 +12,9 @@ from coconet import coconet, parser
 from coconet.core.config import Configuration
 from coconet.log import setup_logger
 
+sys.path.append(str(Path(__file__).resolve().parents[1] / 'common'))
+from coconet_cache import CoCoNetCache
+
 
 def coconet_init(args):
     setup_logger('CoCoNet', Path(args.output, 'CoCoNet.log'), args.loglvl)
@@ -18,10 +22,11 @@ def coconet_init(args):
     cfg.init_config(**vars(args))
     cfg.to_yaml()
 
-    coconet.preprocess(cfg)
-    coconet.make_train_test(cfg)
-    coconet.learn(cfg)
-    coconet.precompute_latent_repr(cfg)
+    cache = CoCoNetCache(cfg, [args.fasta, args.h5] + (getattr(args, 'bam', None) or []))
+    cache.run(coconet.preprocess, ['filt_fasta', 'h5', 'exclude', 'dtr'])
+    cache.run(coconet.make_train_test, ['pairs'])
+    cache.run(coconet.learn, ['model', 'nn_test'])
+    cache.run(coconet.precompute_latent_repr, ['repr'])
 
     return cfg
 
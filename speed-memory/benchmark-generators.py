@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+'''
+Throughput of CoCoNet's CoverageGenerator for different settings
+(batch_size, load_batch, wsize, wstep) on a dataset made by simulation.py
+'''
+
+import argparse
+import resource
+import time
+from pathlib import Path
+from itertools import product
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing as mp
+
+import pandas as pd
+from Bio.SeqIO.FastaIO import SimpleFastaParser
+
+from coconet.fragmentation import make_pairs
+from coconet.core.generators import CoverageGenerator
+
+
+def parse_args():
+    '''
+    '''
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sim', type=str, help='Simulation folder (e.g. simulations/sim-5-10000-1)')
+    parser.add_argument('--batch-size', type=int, nargs='+', default=[256])
+    parser.add_argument('--load-batch', type=int, nargs='+', default=[50, 200, 1000])
+    parser.add_argument('--wsize', type=int, nargs='+', default=[64])
+    parser.add_argument('--wstep', type=int, nargs='+', default=[32])
+    parser.add_argument('--n-pairs', type=int, default=100000)
+    parser.add_argument('--fragment-length', type=int, default=1024)
+    parser.add_argument('--fragment-step', type=int, default=128)
+    parser.add_argument('--output', type=str, default=None)
+    args = parser.parse_args()
+
+    return args
+
+def get_pairs(sim, n_pairs=100000, fragment_length=1024, fragment_step=128):
+    output = Path(sim, f'pairs-{n_pairs}-{fragment_length}-{fragment_step}.npy')
+
+    if not output.is_file():
+        with open(Path(sim, 'assembly.fasta')) as handle:
+            contigs = [(name.split()[0], seq) for (name, seq) in SimpleFastaParser(handle)
+                       if len(seq) > 2*fragment_length]
+        make_pairs(contigs, fragment_step, fragment_length,
+                   output=str(output), n_examples=n_pairs)
+
+    return output
+
+def read_io_counters():
+    '''
+    rchar: bytes read with read syscalls (including the page cache)
+    read_bytes: bytes actually fetched from the storage
+    '''
+
+    with open('/proc/self/io') as handle:
+        counters = dict(line.strip().split(': ') for line in handle)
+
+    return {key: int(counters[key]) for key in ['rchar', 'read_bytes']}
+
+def benchmark(pairs, h5, batch_size=256, load_batch=200, wsize=64, wstep=32):
+    '''
+    Iterate once over all the batches of the pairs file.
+    Runs in a fresh process for each setting so that the peak RSS is not shared.
+    '''
+
+    generator = CoverageGenerator(pairs, h5, batch_size=batch_size,
+                                  load_batch=load_batch, wsize=wsize, wstep=wstep)
+
+    rss_start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    io_start = read_io_counters()
+    start = time.perf_counter()
+
+    n_pairs = sum(len(x1) for (x1, _) in generator)
+
+    duration = time.perf_counter() - start
+    io_end = read_io_counters()
+
+    return dict(
+        batch_size=batch_size, load_batch=load_batch, wsize=wsize, wstep=wstep,
+        pairs_per_sec=n_pairs / duration,
+        seconds=duration,
+        mb_read=(io_end['rchar'] - io_start['rchar']) / 2**20,
+        mb_read_from_disk=(io_end['read_bytes'] - io_start['read_bytes']) / 2**20,
+        peak_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10,
+        baseline_rss_mb=rss_start / 2**10,
+    )
+
+def main():
+    '''
+    '''
+
+    args = parse_args()
+
+    pairs = get_pairs(args.sim, n_pairs=args.n_pairs,
+                      fragment_length=args.fragment_length,
+                      fragment_step=args.fragment_step)
+    h5 = Path(args.sim, 'coverage_contigs.h5')
+
+    settings = list(product(args.batch_size, args.load_batch, args.wsize, args.wstep))
+    results = []
+
+    for (i, (batch_size, load_batch, wsize, wstep)) in enumerate(settings, 1):
+        with ProcessPoolExecutor(1, mp_context=mp.get_context('spawn')) as executor:
+            result = executor.submit(
+                benchmark, str(pairs), str(h5), batch_size=batch_size,
+                load_batch=load_batch, wsize=wsize, wstep=wstep
+            ).result()
+
+        print(f'[{i}/{len(settings)}] batch_size={batch_size}, load_batch={load_batch}, '
+              f'wsize={wsize}, wstep={wstep}: {result["pairs_per_sec"]:,.0f} pairs/s')
+        results.append(result)
+
+    results = (pd.DataFrame(results)
+               .sort_values('pairs_per_sec', ascending=False)
+               .round(1))
+    print(results.to_string(index=False))
+
+    if args.output is not None:
+        results.to_csv(args.output, index=False)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+
+'''
+Run CoCoNet, Metabat2 and CONCOCT on the simulations made by simulation.py
+and sample the resources of each run (RSS, CPU time and I/O of the whole
+process tree, read from /proc) at a fixed interval.
+
+The samples are saved as a tidy time series (one row per tool, dataset and
+sampling time), with the last line logged by the tool at that time so that
+memory peaks can be traced back to a phase of the tool.
+'''
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import threading
+import subprocess
+from pathlib import Path
+
+import pandas as pd
+
+
+ROOT = Path(__file__).resolve().parents[1]
+CLK_TCK = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+def parse_args():
+    '''
+    '''
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('sims', type=str, nargs='+', help='Simulation folders (e.g. simulations/sim-5-1000-1)')
+    parser.add_argument('--tools', type=str, nargs='+', default=['coconet', 'metabat2', 'concoct'],
+                        choices=['coconet', 'metabat2', 'concoct'])
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--min-ctg-len', type=int, default=2048)
+    parser.add_argument('--interval', type=float, default=0.5, help='Sampling interval (seconds)')
+    parser.add_argument('--outdir', type=str, default='benchmark')
+    parser.add_argument('--output', type=str, default='resources.csv')
+    args = parser.parse_args()
+
+    return args
+
+def get_commands(sim, outdir, threads=8, min_ctg_len=2048):
+    '''
+    Command line of each tool. Metabat2 and CONCOCT use the coverage
+    tables made by h5_to_summary_table.py (as in nf-binning).
+    '''
+
+    fasta = Path(sim, 'assembly.fasta')
+    tables = f'{outdir}/coverage_{{}}-{sim.name}.tsv'
+
+    return dict(
+        tables=[
+            sys.executable, str(ROOT / 'binning-comparison/nf-binning/bin/h5_to_summary_table.py'),
+            '--abundance', str(Path(sim, 'coverage_contigs.h5')),
+            '--fasta', str(fasta), '--suffix', sim.name
+        ],
+        coconet=[
+            'coconet', 'run', '--fasta', str(fasta), '--h5', str(Path(sim, 'coverage_contigs.h5')),
+            '--output', f'{outdir}/coconet', '--threads', str(threads),
+            '--min-ctg-len', str(min_ctg_len)
+        ],
+        metabat2=[
+            'metabat2', '-i', str(fasta), '-a', tables.format('metabat2'),
+            '-o', f'{outdir}/metabat2/bin', '-t', str(threads),
+            '--minContig', str(max(min_ctg_len, 1500))
+        ],
+        concoct=[
+            'concoct', '--composition_file', str(fasta),
+            '--coverage_file', tables.format('concoct'),
+            '-b', f'{outdir}/concoct/', '-t', str(threads),
+            '--length_threshold', str(min_ctg_len)
+        ],
+    )
+
+def get_process_tree(pid):
+    '''
+    pid and all its descendants
+    '''
+
+    pids = [pid]
+    for parent in pids:
+        try:
+            for task in os.listdir(f'/proc/{parent}/task'):
+                with open(f'/proc/{parent}/task/{task}/children') as handle:
+                    pids += [int(child) for child in handle.read().split()]
+        except OSError:
+            continue
+
+    return pids
+
+def read_proc(pid):
+    '''
+    RSS (bytes), CPU time (seconds) and I/O (bytes) of one process,
+    and its start time (to tell apart processes reusing a pid)
+    '''
+
+    with open(f'/proc/{pid}/statm') as handle:
+        rss = int(handle.read().split()[1]) * PAGE_SIZE
+
+    with open(f'/proc/{pid}/stat') as handle:
+        # the command name (2nd field) can contain spaces
+        fields = handle.read().rsplit(')', 1)[1].split()
+    cpu_time = (int(fields[11]) + int(fields[12])) / CLK_TCK
+
+    try:
+        with open(f'/proc/{pid}/io') as handle:
+            io = dict(line.strip().split(': ') for line in handle)
+        (read, written) = (int(io['read_bytes']), int(io['write_bytes']))
+    except (OSError, KeyError):
+        (read, written) = (0, 0)
+
+    return (rss, cpu_time, read, written, int(fields[19]))
+
+class ResourceSampler:
+    '''
+    Sample the resources of the process tree of `pid` every `interval`
+    seconds in a background thread. `phase` is recorded with each sample.
+    The CPU time and I/O of the processes that exited are kept at their
+    last sampled value so that these cumulative series do not drop.
+    '''
+
+    def __init__(self, pid, interval=0.5):
+        self.pid = pid
+        self.interval = interval
+        self.phase = ''
+        self.samples = []
+        self.last = {}
+
+        self.start = time.perf_counter()
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            self.sample()
+            if self.stop.wait(self.interval):
+                return
+
+    def sample(self):
+        rss = 0
+        pids = get_process_tree(self.pid)
+
+        for pid in pids:
+            try:
+                (mem, *usage, start_time) = read_proc(pid)
+            except (OSError, ValueError):
+                # process exited in the meantime
+                continue
+            rss += mem
+            self.last[(pid, start_time)] = usage
+
+        (cpu_time, read, written) = ([sum(values) for values in zip(*self.last.values())]
+                                     or [0, 0, 0])
+        self.samples.append(dict(
+            time=time.perf_counter() - self.start,
+            rss_mb=rss / 2**20,
+            cpu_time=cpu_time,
+            read_mb=read / 2**20,
+            write_mb=written / 2**20,
+            n_procs=len(pids),
+            phase=self.phase
+        ))
+
+    def close(self):
+        self.stop.set()
+        self.thread.join()
+
+        return self.samples
+
+def run_tool(cmd, log_file, interval=0.5):
+    '''
+    Run `cmd` while sampling its resources. Returns the samples
+    and a summary from the rusage of the process tree.
+    '''
+
+    start = time.perf_counter()
+
+    with open(log_file, 'w') as log:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                universal_newlines=True)
+        sampler = ResourceSampler(proc.pid, interval=interval)
+
+        for line in proc.stdout:
+            log.write(f'{time.perf_counter()-start:10.2f}\t{line}')
+            if line.strip():
+                sampler.phase = line.strip()[:100]
+
+        (_, status, rusage) = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        samples = sampler.close()
+
+    summary = dict(
+        wall_time=time.perf_counter() - start,
+        peak_rss_mb=rusage.ru_maxrss / 2**10,
+        cpu_time=rusage.ru_utime + rusage.ru_stime,
+        returncode=proc.returncode
+    )
+
+    return (samples, summary)
+
+def main():
+    '''
+    '''
+
+    args = parse_args()
+
+    (resources, summaries) = ([], [])
+
+    for sim in map(Path, args.sims):
+        outdir = Path(args.outdir, sim.name).resolve()
+        outdir.mkdir(parents=True, exist_ok=True)
+
+        commands = get_commands(sim.resolve(), outdir, threads=args.threads,
+                                min_ctg_len=args.min_ctg_len)
+        subprocess.run(commands['tables'], cwd=outdir, check=True)
+
+        # sim-<n_samples>-<n_contigs>-<replicate>
+        (n_samples, n_contigs, replicate) = map(int, sim.name.split('-')[1:])
+
+        for tool in args.tools:
+            if shutil.which(commands[tool][0]) is None:
+                print(f'{commands[tool][0]} not found. Skipping {tool}')
+                continue
+
+            (samples, summary) = run_tool(commands[tool], Path(outdir, f'{tool}.log'),
+                                          interval=args.interval)
+            info = dict(dataset=sim.name, n_samples=n_samples, n_contigs=n_contigs,
+                        replicate=replicate, tool=tool)
+
+            resources += [dict(info, **sample) for sample in samples]
+            summaries.append(dict(info, **summary))
+
+            print(f'{sim.name} - {tool}: {summary["wall_time"]:,.1f}s, '
+                  f'peak RSS={summary["peak_rss_mb"]:,.0f} MB '
+                  f'(exit code {summary["returncode"]})')
+
+    pd.DataFrame(resources).to_csv(args.output, index=False)
+    pd.DataFrame(summaries).to_csv(Path(args.output).with_suffix('.summary.csv'), index=False)
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,12 @@
 #!/usr/bin/env python3
 
+import sys
+import json
 import argparse
 
+import numpy as np
 import pandas as pd
+from scipy import stats
 import seaborn as sns
 import matplotlib.pyplot as plt
 
@@ -22,35 +26,222 @@ def parse_args():
     '''
 
     parser = argparse.ArgumentParser()
-    parser.add_argument('table')
+    parser.add_argument('table', nargs='?',
+                        help='Nextflow trace table or resources.summary.csv from benchmark-tools.py')
+    parser.add_argument('--resources', type=str,
+                        help='Time series of the resources from benchmark-tools.py')
+    parser.add_argument('--fit', action='store_true',
+                        help='Fit the scaling laws (time/memory ~ n_contigs^k) instead of plotting')
+    parser.add_argument('--extrapolate', type=int, default=10**6,
+                        help='Number of contigs to extrapolate the fits to')
+    parser.add_argument('--baseline', type=str,
+                        help='Fits to compare against (json). Exits with 1 if a tool regressed')
+    parser.add_argument('--save-baseline', type=str, help='Save the fits as a baseline (json)')
+    parser.add_argument('--max-exponent-increase', type=float, default=0.1)
+    parser.add_argument('--max-constant-increase', type=float, default=0.25,
+                        help='Maximum relative increase of the constant factor')
     args = parser.parse_args()
 
     return args
 
-def main():
+def load_table(path):
     '''
+    Peak memory (GB) and running time (min) of each tool and dataset,
+    from a Nextflow trace table or from benchmark-tools.py.
+    Failed runs are discarded.
     '''
 
-    args = parse_args()
+    data = pd.read_csv(path, na_values='-')
+    from_trace = 'peak_rss_mb' not in data.columns
 
-    data = pd.read_csv(args.table, na_values='-')
-    data['process'] = data.process.str.split(':').str[-1]
+    exit_codes = data['exit'] if from_trace else data['returncode']
+    data = data.loc[exit_codes == 0].copy()
 
-    processes = {'COCONET_RUN', 'CONCOCT', 'METABAT2'}
-    data = data.loc[data.process.isin(processes)]
+    if from_trace:
+        data['process'] = data.process.str.split(':').str[-1]
+    else:
+        data = data.rename(columns=dict(tool='process'))
 
-    data['n_contigs'] = data.tag.str.split('-').str[2].astype(int)
-    data['time'] = pd.to_timedelta(data.realtime).dt.seconds / 60
+    data['process'] = data.process.str.upper().replace(dict(
+        COCONET='CoCoNet', COCONET_RUN='CoCoNet', METABAT2='Metabat2'
+    ))
+    data = data.loc[data.process.isin({'CoCoNet', 'CONCOCT', 'Metabat2'})].copy()
 
-    rss_values = data.peak_rss.str.split(' ', expand=True)
-    data['rss'] = rss_values[0].astype(float) / rss_values[1].replace(dict(MB=2**10, GB=1))
+    if from_trace:
+        data['n_contigs'] = data.tag.str.split('-').str[2].astype(int)
+        data['time'] = pd.to_timedelta(data.realtime).dt.seconds / 60
 
-    data = (data
-            .replace(dict(COCONET_RUN='CoCoNet', METABAT2='Metabat2'))
+        rss_values = data.peak_rss.str.split(' ', expand=True)
+        data['rss'] = rss_values[0].astype(float) / rss_values[1].replace(dict(MB=2**10, GB=1))
+    else:
+        data['rss'] = data.peak_rss_mb / 2**10
+        data['time'] = data.wall_time / 60
+
+    return (data
             .set_index(['n_contigs', 'process'])[['rss', 'time']]
             .rename_axis(columns='metric')
             .stack().rename('score').reset_index())
 
+def fit_scaling(data, extrapolate=10**6, alpha=0.05):
+    '''
+    Least squares fit of log(score) = log(constant) + exponent*log(n_contigs)
+    for each tool and metric, with (1-alpha) confidence intervals,
+    and the predicted score for `extrapolate` contigs
+    '''
+
+    fits = []
+    for ((process, metric), scores) in data.groupby(['process', 'metric']):
+        scores = scores[scores.score > 0]
+        (x, y) = (np.log(scores.n_contigs.to_numpy(float)), np.log(scores.score.to_numpy(float)))
+        n = len(x)
+
+        if n < 3 or np.unique(x).size < 2:
+            continue
+
+        (slope, intercept) = np.polyfit(x, y, 1)
+        residuals = y - (intercept + slope*x)
+        sigma2 = residuals @ residuals / (n-2)
+        sxx = np.sum((x - x.mean())**2)
+
+        # standard errors of the slope, intercept and prediction at x0
+        se_slope = np.sqrt(sigma2 / sxx)
+        se_intercept = np.sqrt(sigma2 * (1/n + x.mean()**2 / sxx))
+        x0 = np.log(extrapolate)
+        se_pred = np.sqrt(sigma2 * (1/n + (x0 - x.mean())**2 / sxx))
+        t = stats.t.ppf(1 - alpha/2, n-2)
+
+        fits.append(dict(
+            process=process, metric=metric, n_points=n,
+            exponent=slope,
+            exponent_low=slope - t*se_slope, exponent_high=slope + t*se_slope,
+            constant=np.exp(intercept),
+            constant_low=np.exp(intercept - t*se_intercept),
+            constant_high=np.exp(intercept + t*se_intercept),
+            r2=1 - residuals @ residuals / np.sum((y - y.mean())**2),
+            extrapolated=np.exp(intercept + slope*x0),
+            extrapolated_low=np.exp(intercept + slope*x0 - t*se_pred),
+            extrapolated_high=np.exp(intercept + slope*x0 + t*se_pred),
+        ))
+
+    return pd.DataFrame(fits)
+
+def find_regressions(fits, baseline, max_exponent_increase=0.1, max_constant_increase=0.25):
+    '''
+    Tools whose exponent or constant factor increased more than allowed
+    compared to the `baseline` fits, or that are in the baseline but
+    could not be fitted anymore (e.g. because their runs failed)
+    '''
+
+    regressions = []
+    fitted = set(zip(fits.get('process', []), fits.get('metric', [])))
+
+    for (process, metrics) in baseline.items():
+        for metric in metrics:
+            if (process, metric) not in fitted:
+                regressions.append(f'{process} ({metric}): no fit (missing or failed runs)')
+
+    for fit in fits.itertuples():
+        ref = baseline.get(fit.process, {}).get(fit.metric)
+        if ref is None:
+            continue
+
+        if fit.exponent - ref['exponent'] > max_exponent_increase:
+            regressions.append(f'{fit.process} ({fit.metric}): exponent '
+                               f'{ref["exponent"]:.3f} -> {fit.exponent:.3f}')
+        if fit.constant / ref['constant'] - 1 > max_constant_increase:
+            regressions.append(f'{fit.process} ({fit.metric}): constant '
+                               f'{ref["constant"]:.3g} -> {fit.constant:.3g}')
+
+    return regressions
+
+def check_scaling(args):
+    if args.table is None:
+        sys.exit('--fit needs a trace table or a resources.summary.csv')
+
+    data = load_table(args.table)
+    if data.empty:
+        sys.exit(f'No successful run of CoCoNet, CONCOCT or Metabat2 in {args.table}')
+
+    fits = fit_scaling(data, extrapolate=args.extrapolate)
+
+    units = dict(rss='GB', time='min')
+    for fit in fits.itertuples():
+        print(f'{fit.process:>8} {fit.metric:>4}: ~ n^{fit.exponent:.3f} '
+              f'(95% CI: {fit.exponent_low:.3f}-{fit.exponent_high:.3f}, R2={fit.r2:.3f}), '
+              f'{args.extrapolate:,} contigs: {fit.extrapolated:,.1f} {units[fit.metric]} '
+              f'({fit.extrapolated_low:,.1f}-{fit.extrapolated_high:,.1f})')
+
+    fits.to_csv('scaling-fits.csv', index=False)
+
+    if args.save_baseline is not None:
+        baseline = {}
+        for fit in fits.itertuples():
+            baseline.setdefault(fit.process, {})[fit.metric] = dict(
+                exponent=fit.exponent, constant=fit.constant
+            )
+        with open(args.save_baseline, 'w') as handle:
+            json.dump(baseline, handle, indent=2)
+
+    if args.baseline is None:
+        return 0
+
+    with open(args.baseline) as handle:
+        regressions = find_regressions(fits, json.load(handle),
+                                       max_exponent_increase=args.max_exponent_increase,
+                                       max_constant_increase=args.max_constant_increase)
+
+    for regression in regressions:
+        print(f'REGRESSION: {regression}')
+
+    return int(len(regressions) > 0)
+
+def plot_resources(path):
+    '''
+    Memory over time of each tool, with the peak of each run marked
+    and reported with the phase logged by the tool at that time
+    '''
+
+    data = pd.read_csv(path).fillna(dict(phase=''))
+    data['tool'] = data.tool.replace(dict(coconet='CoCoNet', metabat2='Metabat2', concoct='CONCOCT'))
+    data['rss'] = data.rss_mb / 2**10
+
+    peaks = data.loc[data.groupby(['dataset', 'tool']).rss.idxmax()]
+    print(peaks[['dataset', 'tool', 'time', 'rss', 'phase']]
+          .rename(columns=dict(time='time (s)', rss='peak RSS (GB)'))
+          .to_string(index=False))
+
+    g = sns.relplot(data=data, x='time', y='rss', hue='tool', col='n_contigs', col_wrap=4,
+                    units='replicate', estimator=None, kind='line', linewidth=1.5,
+                    facet_kws=dict(sharex=False, sharey=False))
+
+    for (n_contigs, ax) in g.axes_dict.items():
+        facet_peaks = peaks[peaks.n_contigs == n_contigs]
+        ax.scatter(facet_peaks.time, facet_peaks.rss, color='black', marker='x', zorder=3)
+
+    g.set(xlabel='Time (s)', ylabel='Memory (GB)')
+    g.set_titles(col_template='{col_name} contigs')
+    g._legend.set_title(None)
+
+    g.savefig('memory-over-time.pdf')
+
+def main():
+    '''
+    '''
+
+    args = parse_args()
+
+    if args.fit:
+        sys.exit(check_scaling(args))
+
+    if args.resources is not None:
+        plot_resources(args.resources)
+
+    if args.table is None:
+        plt.show()
+        return
+
+    data = load_table(args.table)
+
     g = sns.relplot(data=data, col='metric', hue='process', style='process',
                     facet_kws=dict(sharey=False),
                     err_style='bars', ci='sd', linewidth=2,
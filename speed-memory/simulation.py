@@ -1,84 +1,214 @@
 #!/usr/bin/env python3
 
+import sys
+import time
 import argparse
-import random
 from pathlib import Path
+from itertools import product
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing as mp
 
 import numpy as np
-from Bio import SeqIO
+from Bio.SeqIO.FastaIO import SimpleFastaParser
 
-import h5py
+sys.path.append(str(Path(__file__).resolve().parents[1] / 'common'))
+from coverage_h5 import coverage_writer
+
+# Genome database of the grid workers, inherited from the parent process
+GENOMES = None
 
 
 def parse_args():
 
     parser = argparse.ArgumentParser()
     parser.add_argument('--db', type=str)
-    parser.add_argument('--n-contigs', type=int, default=10)
-    parser.add_argument('--n-samples', type=int, default=5)
+    parser.add_argument('--n-contigs', type=int, nargs='+', default=[10])
+    parser.add_argument('--n-samples', type=int, nargs='+', default=[5])
     parser.add_argument('--min-genome-len', type=int, default=4000)
-    parser.add_argument('--replicate', type=int, default=1)    
+    parser.add_argument('--replicate', type=int, nargs='+', default=[1])
+    parser.add_argument('--seed', type=int, default=None,
+                        help=('Master seed. Each simulation of the grid '
+                              '(n_samples x n_contigs x replicate) derives its own seed from it'))
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of simulations generated in parallel')
+    parser.add_argument('--layout', type=str, default='datasets', choices=['datasets', 'ragged'],
+                        help='Coverage H5 layout (CoCoNet reads the "datasets" layout)')
     args = parser.parse_args()
 
     return args
 
-def split_genomes(genomes, coverage, n_contigs=10, suffix='',
-                  min_ctg_len=2048):
+class GenomeDB:
+    '''
+    Genomes longer than `min_len`, with all sequences in a single
+    bytes buffer: forked workers share it (copy-on-write) without
+    touching one python object per genome.
+    '''
+
+    def __init__(self, fasta, min_len=0):
+        (ids, seqs) = ([], [])
+
+        with open(fasta) as handle:
+            for (title, seq) in SimpleFastaParser(handle):
+                if len(seq) > min_len:
+                    ids.append(title.split()[0])
+                    seqs.append(seq)
+
+        self.ids = ids
+        self.lengths = np.array([len(seq) for seq in seqs], dtype=np.int64)
+        self.offsets = np.cumsum(self.lengths) - self.lengths
+        self.seqs = ''.join(seqs).encode()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def fetch(self, i, start, end):
+        offset = self.offsets[i]
+        return self.seqs[offset+start:offset+end].decode()
+
+def plan_contigs(genome_lengths, n_contigs=10, min_ctg_len=2048, rng=None, pilot=100):
+    '''
+    Contigs made by splitting randomly picked genomes (with replacement):
+    each pick is a new virus, split at 1 to len//min_ctg_len random breakpoints,
+    and the pieces shorter than min_ctg_len are discarded.
+    Picks and breakpoints are drawn in bulk, in rounds sized from the
+    number of contigs per pick observed so far.
+
+    Returns the (pick, genome, index in pick, start, end) arrays.
+    '''
+
+    if rng is None:
+        rng = np.random.default_rng()
+
+    genome_lengths = np.asarray(genome_lengths)
+    valid = np.flatnonzero(genome_lengths > min_ctg_len)
+
+    if valid.size == 0:
+        raise ValueError(f'Cannot make any contig of {min_ctg_len} bp or more: '
+                         f'all {len(genome_lengths)} genomes are shorter')
+
+    rounds = []
+    (n_picks, n_planned) = (0, 0)
+
+    while n_planned < n_contigs:
+        remaining = n_contigs - n_planned
+        rate = n_planned / n_picks if n_picks else 1
+        size = min(remaining, pilot) if n_picks == 0 else int(np.ceil(remaining / rate))
+
+        genomes = valid[rng.integers(len(valid), size=size)]
+        lengths = genome_lengths[genomes]
+        n_splits = 1 + rng.integers(lengths // min_ctg_len)
+
+        # One row per breakpoint, sorted by pick then position
+        picks = np.repeat(np.arange(size), n_splits)
+        starts = rng.integers(lengths[picks] - min_ctg_len)
+        order = np.lexsort((starts, picks))
+        (picks, starts) = (picks[order], starts[order])
+
+        # Each piece ends at the next breakpoint of its pick (or at the genome end)
+        last = np.r_[picks[1:] != picks[:-1], True]
+        ends = np.where(last, lengths[picks], np.r_[starts[1:], 0])
+
+        keep = (ends - starts) >= min_ctg_len
+        (picks, starts, ends) = (picks[keep], starts[keep], ends[keep])
+
+        first = np.r_[True, picks[1:] != picks[:-1]]
+        first_idx = np.maximum.accumulate(np.where(first, np.arange(len(picks)), 0))
+        index = np.arange(len(picks)) - first_idx
+
+        rounds.append((picks + n_picks, genomes[picks], index, starts, ends))
+        n_picks += size
+        n_planned += len(picks)
+
+    return [np.concatenate(arrays)[:n_contigs] for arrays in zip(*rounds)]
+
+def split_genomes(genomes, n_contigs=10, n_samples=5, suffix='',
+                  min_ctg_len=2048, rng=None, layout='datasets'):
+    '''
+    Split random genomes of `genomes` (GenomeDB) into `n_contigs` contigs.
+    Coverage is only generated for the contigs that are written,
+    so that memory does not depend on the size of the database
+    '''
+
+    if rng is None:
+        rng = np.random.default_rng()
 
     outdir = Path('simulations', f'sim-{suffix}')
     outdir.mkdir(exist_ok=True, parents=True)
 
-    ctg_handle = open(f'{outdir}/assembly.fasta', 'w')
-    h5_handle = h5py.File(f'{outdir}/coverage_contigs.h5', 'w')
-
-    genome_count = 0
-    ctg_count = 0
-
-    while True:
-        genome = random.choice(genomes)
-        genome_seq = str(genome.seq)
-        n_splits = 1+random.choice(range(len(genome.seq)//min_ctg_len))
-
-        starts = sorted(np.random.randint(0, len(genome_seq)-min_ctg_len, n_splits))
-        ends = np.diff(starts, append=len(genome.seq))
-        itv = filter(lambda x: (x[1]-x[0])>=2048, zip(starts, ends))
-
-        for i, (start, end) in enumerate(itv):
-            ctg_handle.write(f'>V{genome_count}|{i}\n{genome_seq[start:end]}\n')
-            h5_handle.create_dataset(
-                f'V{genome_count}|{i}',
-                data=coverage[genome.id][:, start:end]
-            )
-            ctg_count += 1
-
-            if ctg_count >= n_contigs:
-                ctg_handle.close()
-                h5_handle.close()
-                return
-
-        genome_count += 1
-
-def generate_coverage(genomes, n_samples=5):
-    coverage = {}
-    for genome in genomes:
-        mus = np.random.lognormal(1, 2, size=n_samples)
-        coverage[genome.id] = np.stack([
-            np.random.poisson(mu, len(genome.seq))
-            for mu in mus
-        ])
-    return coverage
+    (picks, genome_idx, index, starts, ends) = plan_contigs(
+        genomes.lengths, n_contigs=n_contigs,
+        min_ctg_len=min_ctg_len, rng=rng
+    )
+
+    # One abundance profile per genome, shared by all its picks
+    (used, genome_idx) = np.unique(genome_idx, return_inverse=True)
+    abundances = rng.lognormal(1, 2, size=(len(used), n_samples))
+
+    with open(f'{outdir}/assembly.fasta', 'w') as ctg_handle, \
+         open(f'{outdir}/contigs.tsv', 'w') as table_handle, \
+         coverage_writer(f'{outdir}/coverage_contigs.h5', n_samples, layout=layout) as h5_handle:
+
+        table_handle.write('contig\tgenome\tstart\tend\n')
+
+        for (pick, genome, i, start, end) in zip(picks, genome_idx, index, starts, ends):
+            name = f'V{pick}|{i}'
+            seq = genomes.fetch(used[genome], start, end)
+
+            ctg_handle.write(f'>{name}\n{seq}\n')
+            table_handle.write(f'{name}\t{genomes.ids[used[genome]]}\t{start}\t{end}\n')
+            h5_handle.append(name, generate_coverage(abundances[genome], end-start, rng))
+
+def generate_coverage(mus, length, rng, dtype=np.uint32):
+    '''
+    Poisson coverage of a contig with mean `mus` in each sample
+    '''
+
+    coverage = rng.poisson(np.asarray(mus)[:, None], size=(len(mus), length))
+
+    return coverage.astype(dtype, copy=False)
+
+def simulate(n_samples, n_contigs, replicate, master_seed, layout='datasets'):
+    '''
+    One simulation of the grid. The seed only depends on the master seed
+    and on the parameters, not on the grid or on the scheduling.
+    '''
+
+    start = time.perf_counter()
+    seed = np.random.SeedSequence(master_seed, spawn_key=(n_samples, n_contigs, replicate))
+
+    label = f'{n_samples}-{n_contigs}-{replicate}'
+    split_genomes(GENOMES, suffix=label, n_contigs=n_contigs, n_samples=n_samples,
+                  min_ctg_len=2048, rng=np.random.default_rng(seed), layout=layout)
+
+    return (label, time.perf_counter() - start)
 
 def main():
+    global GENOMES
+
     args = parse_args()
 
-    label = f'{args.n_samples}-{args.n_contigs}-{args.replicate}'
+    master_seed = args.seed
+    if master_seed is None:
+        master_seed = np.random.SeedSequence().entropy
+    print(f'Master seed: {master_seed}')
+
+    GENOMES = GenomeDB(args.db, min_len=args.min_genome_len)
+    tasks = list(product(args.n_samples, args.n_contigs, args.replicate))
 
-    genomes = [genome for genome in SeqIO.parse(args.db,'fasta')
-               if len(genome.seq) > args.min_genome_len]
+    if args.workers <= 1:
+        for (i, task) in enumerate(tasks, 1):
+            (label, duration) = simulate(*task, master_seed, layout=args.layout)
+            print(f'[{i}/{len(tasks)}] sim-{label}: {duration:.1f}s')
+        return
 
-    coverage = generate_coverage(genomes, n_samples=args.n_samples)
+    # Forked workers share GENOMES with the parent
+    with ProcessPoolExecutor(args.workers, mp_context=mp.get_context('fork')) as executor:
+        jobs = [executor.submit(simulate, *task, master_seed, layout=args.layout)
+                for task in tasks]
 
-    split_genomes(genomes, coverage, suffix=label, n_contigs=args.n_contigs, min_ctg_len=2048)
+        for (i, job) in enumerate(as_completed(jobs), 1):
+            (label, duration) = job.result()
+            print(f'[{i}/{len(tasks)}] sim-{label}: {duration:.1f}s')
 
 if __name__ == '__main__':
     main()